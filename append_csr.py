@@ -2,23 +2,40 @@
 
 import argparse
 import hashlib
-import subprocess
+import os
 import sys
 
 from Crypto.IO import PEM
 from nacl import signing  # counter-intuitively, this is from pycryptodome: `pip3 install pycryptodome` (ubuntu) `pip install pycryptodome` (maybe others?)
 # note: if you did the sensible thing and tried to install the crypto or pycrypto libraries first when you hit this error
 # you have to uninstall those before putting in pycryptodome: `pip remove crypto`, and then `pip install pycryptodome` (or pip3 on ubuntu)
-from nacl.signing import SigningKey # from pynacl package: `pip3 install pynacl`
+from nacl.signing import SigningKey, VerifyKey # from pynacl package: `pip3 install pynacl`
 from nacl.encoding import RawEncoder
+from nacl.exceptions import BadSignatureError
+import nacl.bindings
 
 import socket
 from datetime import datetime
 import hashlib
 import binascii
 
+import gitinfo
+import xc7bitstream
+
 DEVKEY_PATH='./devkey/dev.key'
-SIGNER_VERSION=1
+SIGNER_VERSION=1 # Ed25519 over the signed image
+SIGNER_VERSION_PREHASH=2 # Ed25519ph (RFC 8032, empty context): Ed25519 over the SHA-512 of the signed image
+
+# image layout: the regions sit at fixed offsets, everything in between is 0xff
+TOTAL_LEN     = 0x28_0000
+SIGNATURE_LOC = 0x27_F000
+CSR_CSV_LOC   = 0x27_7000
+METADATA_LOC  = 0x27_6000
+CSV_PAD_TO    = 0x7FC0 # CSV appendix length, before the SHA-512 digest
+AES_PADDING   = 8 # insert padding so that AES blocks line up on erase block boundaries
+# this may have to be adjusted if you change the bitstream header parameters
+
+CHUNK_SIZE = 0x1_0000 # input is read, hashed and written in chunks of this size
 
 def bytestring_to_record(b, maxlen):
     if len(b) > maxlen:
@@ -36,11 +53,11 @@ def compute_metadata(checksum):
     hostname = socket.gethostname()
     date = str(datetime.now())
     source_checksum = hashlib.md5(open('betrusted_soc.py', 'rb').read()).digest()
-    tags = subprocess.check_output(["git", "describe", "--tags"])
-    log = subprocess.check_output(["git", "log", "--name-status", "HEAD^..HEAD"])
-    status_raw = subprocess.check_output(["git", "status"])
+    git = gitinfo.git_info()
+    tags = git.tags
+    log = git.log
     status = ""
-    for line in status_raw.decode('utf-8').splitlines():
+    for line in git.status.decode('utf-8').splitlines():
         # use splitlines() because windows does \n\r, linux does \n only, and splitlines() handles both cases, removing all newline characters
         if "On branch" in line:
             status += line.replace("\t", " ")
@@ -95,7 +112,151 @@ def compute_metadata(checksum):
     return meta
 
 
-def main():
+"""
+The image is assembled as a stream: each input is read once, in chunks, and every chunk is
+fed to whichever hashes cover it (the MD5 bitstream checksum in the metadata, the SHA-512
+digest of the CSV appendix, and the signer) and written straight to the output file.
+
+Signers take the signed part of the image through update(), and produce the signature with
+sign(). The signer version goes into the signature block, so that the verifier knows which
+scheme to check:
+
+  1  Ed25519Signer. Pure Ed25519 hashes the message twice, so the signed image has to be
+     kept in memory until the end; the rest of the pipeline holds a chunk at a time.
+  2  Ed25519phSigner (--prehash). The image is hashed with SHA-512 as it streams past, and
+     only the digest is signed, so signing is a single pass in constant memory. Verifiers
+     that only know version 1 reject these images.
+"""
+class Ed25519Signer:
+    version = SIGNER_VERSION
+
+    def __init__(self, signing_key):
+        self.signing_key = signing_key
+        self.message = bytearray()
+
+    def update(self, data):
+        self.message += data
+
+    def sign(self):
+        return self.signing_key.sign(bytes(self.message), encoder=RawEncoder).signature
+
+class Ed25519phSigner:
+    version = SIGNER_VERSION_PREHASH
+
+    def __init__(self, signing_key):
+        (public_key, self.secret_key) = nacl.bindings.crypto_sign_seed_keypair(signing_key.encode())
+        self.state = nacl.bindings.crypto_sign_ed25519ph_state()
+
+    def update(self, data):
+        nacl.bindings.crypto_sign_ed25519ph_update(self.state, bytes(data))
+
+    def sign(self):
+        return nacl.bindings.crypto_sign_ed25519ph_final_create(self.state, self.secret_key)
+
+SIGNERS = {SIGNER_VERSION: Ed25519Signer, SIGNER_VERSION_PREHASH: Ed25519phSigner}
+
+# writes the signed part of the image, keeping track of the offset
+class ImageWriter:
+    def __init__(self, ofile, signer):
+        self.ofile = ofile
+        self.signer = signer
+        self.written = 0
+
+    def write(self, data):
+        self.ofile.write(data)
+        self.signer.update(data)
+        self.written += len(data)
+
+    # fill with 0xff up to offset, where the next region starts
+    def pad_to(self, offset, region):
+        if self.written > offset:
+            raise ValueError("image overlaps the {} at 0x{:x}".format(region, offset))
+        while self.written < offset:
+            self.write(bytes([0xff]) * min(CHUNK_SIZE, offset - self.written))
+
+    # append the signature block, and pad the image to TOTAL_LEN
+    def finish(self):
+        assert(self.written == SIGNATURE_LOC)
+        signature = self.signer.sign()
+        block = int(self.signer.version).to_bytes(4, 'little') + int(self.written).to_bytes(4, 'little') + signature
+        self.ofile.write(block)
+        self.ofile.write(bytes([0xff]) * (TOTAL_LEN - SIGNATURE_LOC - len(block)))
+
+# yield the bitstream from the sync word on, skipping the preamble junk that's ignored;
+# every byte read, preamble included, goes into checksum
+def program_chunks(bitstream, checksum):
+    searched = b''
+    found = False
+    for chunk in iter(lambda: bitstream.read(CHUNK_SIZE), b''):
+        checksum.update(chunk)
+        if found:
+            yield chunk
+            continue
+        # keep the tail of what was searched, in case the sync word straddles two chunks
+        searched = searched[-3:] + chunk
+        position = xc7bitstream.find_sync(searched)
+        if position >= 0:
+            found = True
+            yield searched[position:]
+    if not found:
+        raise ValueError("no sync word found in the bitstream")
+
+# write the CSV appendix: length, CSV data and git revision, 0xff padding to CSV_PAD_TO, and
+# the SHA-512 digest of all of that
+def write_csv_appendix(image, ifile, rev):
+    size = os.fstat(ifile.fileno()).st_size + len(b"git_rev,") + len(rev)
+    if size + 4 > CSV_PAD_TO:
+        raise ValueError("CSV data is {} bytes, the appendix only has room for {}".format(size, CSV_PAD_TO - 4))
+    hasher = hashlib.sha512()
+    def write(data):
+        hasher.update(data)
+        image.write(data)
+    write(size.to_bytes(4, 'little'))
+    for chunk in iter(lambda: ifile.read(CHUNK_SIZE), b''):
+        write(chunk)
+    write(b"git_rev," + rev)
+    if image.written != CSR_CSV_LOC + 4 + size:
+        raise ValueError("CSV file changed while it was being read")
+    write(bytes([0xff]) * (CSV_PAD_TO - size - 4))
+    image.write(hasher.digest())
+
+"""
+Check the signature of an assembled image against an Ed25519 public key (32 raw bytes).
+Returns the signer version; a malformed signature block or a bad signature raises
+ValueError. Version 2 images are verified in a single streaming pass, like they are signed.
+"""
+def verify_image(ifile, public_key):
+    ifile.seek(SIGNATURE_LOC)
+    block = ifile.read(4 + 4 + 64)
+    if len(block) != 4 + 4 + 64:
+        raise ValueError("image is truncated, there is no signature block at 0x{:x}".format(SIGNATURE_LOC))
+    version = int.from_bytes(block[0:4], 'little')
+    signed_len = int.from_bytes(block[4:8], 'little')
+    signature = block[8:]
+    if version not in SIGNERS:
+        raise ValueError("unknown signer version {}".format(version))
+    if signed_len != SIGNATURE_LOC:
+        raise ValueError("signed length 0x{:x} does not cover the image up to the signature block".format(signed_len))
+
+    ifile.seek(0)
+    try:
+        if version == SIGNER_VERSION_PREHASH:
+            state = nacl.bindings.crypto_sign_ed25519ph_state()
+            remaining = signed_len
+            while remaining > 0:
+                chunk = ifile.read(min(CHUNK_SIZE, remaining))
+                if len(chunk) == 0:
+                    raise ValueError("image is truncated")
+                nacl.bindings.crypto_sign_ed25519ph_update(state, chunk)
+                remaining -= len(chunk)
+            nacl.bindings.crypto_sign_ed25519ph_final_verify(state, signature, public_key)
+        else:
+            VerifyKey(public_key, encoder=RawEncoder).verify(ifile.read(signed_len), signature)
+    except BadSignatureError:
+        raise ValueError("signature check failed")
+    return version
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Pad and append CSV file to FPGA bitstream")
     parser.add_argument(
         "-b", "--bitstream", required=True, help="file containing FPGA bitstream", type=str
@@ -109,8 +270,12 @@ def main():
     parser.add_argument(
         "--key", required=False, help="signing key", type=str, nargs='?', metavar=('signing key'), const=DEVKEY_PATH
     )
+    parser.add_argument(
+        "--prehash", help="sign the SHA-512 of the image with Ed25519ph (signer version {}), in one streaming pass".format(SIGNER_VERSION_PREHASH),
+        action="store_true"
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.key is None:
         key = DEVKEY_PATH
@@ -130,86 +295,38 @@ def main():
             print("PEM type for loader was not a private key. Aborting.")
             exit(1)
 
-    checksum = hashlib.md5(open(args.bitstream, 'rb').read()).digest()
-
     # NOTE NOTE NOTE
     # can't find a good ASN.1 ED25519 key decoder, just relying on the fact that the last 32 bytes are "always" the private key. always? the private key?
     signing_key = SigningKey(key_pkey[-32:], encoder=RawEncoder)
-    signing_data = list()
 
-    TOTAL_LEN     = 0x28_0000
-    SIGNATURE_LOC = 0x27_F000
-    CSR_CSV_LOC   = 0x27_7000
-    METADATA_LOC  = 0x27_6000
-    pad_to = 0x7FC0
+    rev = gitinfo.git_info().rev
+
     with open(args.bitstream, "rb") as bitstream:
         with open(args.csv_file, "rb") as ifile:
             with open(args.output_file, "wb") as ofile:
-                # create the CSV appendix
-                data = ifile.read() # read in the whole block of CSV data
-
-                git_rev = subprocess.Popen(["git", "describe", "--long", "--always"],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-                (rev, err) = git_rev.communicate()
-                data += b"git_rev,"
-                data += rev
-
-                odata = bytearray()
-                odata += len(data).to_bytes(4, 'little')
-                odata += data
-
-                padding = bytes([0xff]) * (pad_to - len(data) - 4)
-                odata += padding
-
-                hasher = hashlib.sha512()
-                hasher.update(odata)
-                digest = hasher.digest()
-                odata += digest
-                # odata now contains the csv appendix
-
-                # assemble the final output file
-                bits = bitstream.read() # read in all the bitstream
-                position = 0
-                # seek past the preamble junk that's ignored
-                while position < len(bits):
-                   sync = int.from_bytes(bits[position:position + 4], 'big')
-                   if sync == 0xaa995566:
-                      break
-                   position = position + 1
-                program_data = bits[position:]
-
-                aes_padding = 8 # insert padding so that AES blocks line up on erase block boundaries
-                # this may have to be adjusted if you change the bitstream header parameters
-                written = 0
-                written += ofile.write(bytes([0xff] * aes_padding))
-                signing_data += bytes([0xff] * aes_padding)
-
-                written += ofile.write(program_data)
-                signing_data += program_data
-
-                # insert metadata
-                metadata_pad = bytes([0xff]) * (METADATA_LOC - written)
-                written += ofile.write(metadata_pad)
-                signing_data += metadata_pad
-                metadata = compute_metadata(checksum)
-                assert(written == METADATA_LOC)
-                written += ofile.write(metadata)
-                signing_data += metadata
-
-                assert(written == CSR_CSV_LOC)
-                # add the CSR data
-                written += ofile.write(odata)
-                signing_data += odata
-
-                assert(written == SIGNATURE_LOC)
-
-                signature = signing_key.sign(signing_data, encoder=RawEncoder)
-                written += ofile.write((int(SIGNER_VERSION).to_bytes(4, 'little')))
-                written += ofile.write(len(signing_data).to_bytes(4, 'little'))
-                written += ofile.write(signature.signature)
-                written += ofile.write(bytes([0xff]) * (TOTAL_LEN - written))
-                assert(written == TOTAL_LEN)
+                if args.prehash:
+                    signer = Ed25519phSigner(signing_key)
+                else:
+                    signer = Ed25519Signer(signing_key)
+                image = ImageWriter(ofile, signer)
+                try:
+                    image.write(bytes([0xff] * AES_PADDING))
+                    checksum = hashlib.md5()
+                    for chunk in program_chunks(bitstream, checksum):
+                        image.write(chunk)
+
+                    # insert metadata
+                    image.pad_to(METADATA_LOC, "metadata")
+                    image.write(compute_metadata(checksum.digest()))
+
+                    # add the CSR data
+                    image.pad_to(CSR_CSV_LOC, "CSV appendix")
+                    write_csv_appendix(image, ifile, rev)
+                except ValueError as e:
+                    print("{}, can't build {}. Aborting.".format(e, args.output_file))
+                    exit(1)
+
+                image.finish()
 
 if __name__ == "__main__":
     main()
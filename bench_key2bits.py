@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks for the key ROM patch pipeline in key2bits.py.
+
+Each stage of the pipeline is timed separately:
+
+  load-sources   parse tilegrid.json and the part json (segbits are loaded on first use)
+  load-cache     load the same databases through the compiled cache
+  translate-walk frame address -> framestream position with address_to_framestream()
+  translate      the same with FramestreamIndex.translate_many()
+  derive-plan    resolve rom.db into a patch plan
+  apply          gather the patch words for one key
+  patch-text     write a text patch list
+  patch-binary   write a binary patch list
+  rust-codegen   generate fw/rom-inject/src/lib.rs
+
+The part json and segbits file are the vendored ones in db/. tilegrid.json and rom.db are not
+vendored, so unless --tilegrid and --romdb are given, a synthetic tile grid and ROM placement
+are generated, with the 32 ROM bits striped over CLBs in a few columns.
+
+Results can be saved as a baseline, and later runs compared against it; a stage that is
+slower than the baseline by more than --tolerance fails the run. Independently of any
+baseline, Rust code generation has to reach --codegen-target MB/s of generated source, so
+that lib.rs for a deeper key ROM stays cheap to produce.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import key2bits
+
+CODEGEN_TARGET = 4.0 # MB/s of generated Rust source
+
+"""
+Generate a tilegrid.json and rom.db pair that places the key ROM in CLBLL_L tiles: each
+ROM data bit gets one slice per four LUT stripes, and each slice's LUTs A-D hold four of the
+bit's stripes.
+"""
+def synthetic_inputs(seed=0, geometry=key2bits.DEFAULT_GEOMETRY):
+    rng = random.Random(seed)
+    columns = [0x00000C00, 0x00000D00, 0x00020E00, 0x00401A00]
+    tilegrid = {}
+    rom_db = []
+    for bit in range(geometry.width):
+        column = bit // 8
+        for lut in range(geometry.luts):
+            y = 50 + (bit % 8) // 2 + (lut // 4) * 4
+            x = 36 + column * 4 + (bit % 2)
+            tile = "CLBLL_L_X{}Y{}".format(24 + column, y)
+            even = x - (x % 2)
+            tilegrid[tile] = {
+                "bits": {"CLB_IO_CLK": {"baseaddr": "0x{:08X}".format(columns[column]), "frames": 36,
+                                        "offset": (y - 50) * 2, "words": 2}},
+                "grid_x": 0, "grid_y": 0, "pin_functions": {},
+                "sites": {"SLICE_X{}Y{}".format(even, y): "SLICEL", "SLICE_X{}Y{}".format(even + 1, y): "SLICEL"},
+                "type": "CLBLL_L",
+            }
+            rom_db.append("KEYROM {} {} SLICE_X{}Y{} b'{:016x}' {}".format(bit, geometry.stripe_name(lut), x, y,
+                                                                         rng.getrandbits(64), "ABCD"[lut % 4]))
+    return json.dumps(tilegrid, indent=1), "\n".join(rom_db) + "\n"
+
+def random_keyrom(rng):
+    return [rng.getrandbits(32) for i in range(key2bits.ROM_DEPTH)]
+
+# run fn repeat times and return the fastest time, in seconds
+def best_of(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run(tilegrid_file, part_file, segbits_file, romdb_file, repeat, workdir):
+    results = {}
+    rng = random.Random(1)
+
+    results['load-sources'] = best_of(lambda: key2bits.PartDatabase.from_sources(tilegrid_file, part_file, segbits_file), repeat)
+    cache_file = os.path.join(workdir, 'key2bits.cache')
+    key2bits.load_part_database(tilegrid_file, part_file, segbits_file, cache_file)
+    results['load-cache'] = best_of(lambda: key2bits.load_part_database(tilegrid_file, part_file, segbits_file, cache_file), repeat)
+
+    part = key2bits.load_part_database(tilegrid_file, part_file, segbits_file, cache_file)
+    with open(part_file, "r") as f:
+        part_db = json.load(f)
+    # random frame addresses, sorted as the plan derivation presents them; the reference walk
+    # is slow enough that it only gets a tenth of them
+    addresses = sorted(rng.getrandbits(26) for i in range(10000))
+    walk_addresses = addresses[:1000]
+    results['translate-walk'] = best_of(lambda: [key2bits.address_to_framestream(part_db, a) for a in walk_addresses], repeat)
+    results['translate'] = best_of(lambda: part.framestream.translate_many(addresses), repeat)
+
+    rom_db = key2bits.read_rom_db(romdb_file)
+    results['derive-plan'] = best_of(lambda: key2bits.derive_plan(part, rom_db), repeat)
+    plan = key2bits.derive_plan(part, rom_db)
+
+    keyrom = random_keyrom(rng)
+    results['apply'] = best_of(lambda: plan.apply(keyrom), repeat)
+    patches = plan.apply(keyrom)
+    results['patch-text'] = best_of(lambda: key2bits.write_patches(io.StringIO(), patches), repeat)
+    results['patch-binary'] = best_of(lambda: key2bits.write_patches(io.BytesIO(), patches, 'binary'), repeat)
+    results['rust-codegen'] = best_of(lambda: key2bits.write_rust(io.StringIO(), plan, keyrom, patches), repeat)
+    rust = io.StringIO()
+    key2bits.write_rust(rust, plan, keyrom, patches)
+
+    throughput = {
+        'translate frames/s': len(addresses) / results['translate'],
+        'translate-walk frames/s': len(walk_addresses) / results['translate-walk'],
+        'apply keys/s': 1 / results['apply'],
+        'seal keys/s': 1 / (results['apply'] + results['patch-text']),
+        'rust-codegen MB/s': len(rust.getvalue()) / results['rust-codegen'] / 1e6,
+    }
+    print("plan: {} frames, {} words".format(len(plan.frame_positions()), len(plan)))
+    return results, throughput
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the key2bits key ROM patch pipeline")
+    parser.add_argument("-t", "--tilegrid", help="tilegrid file, defaults to a synthetic one", type=str)
+    parser.add_argument("-r", "--romdb", help="ROM LUT mapping database, defaults to a synthetic one", type=str)
+    parser.add_argument("-p", "--part", help="Part frame mapping file", default=key2bits.DEFAULT_PART, type=str)
+    parser.add_argument("-s", "--segbits", help="segbits file", default=key2bits.DEFAULT_SEGBITS, type=str)
+    parser.add_argument("-n", "--repeat", help="runs per stage, the fastest is reported", default=5, type=int)
+    parser.add_argument("--save-baseline", help="write the results to this baseline file", type=str)
+    parser.add_argument("--baseline", help="compare the results against this baseline file", type=str)
+    parser.add_argument("--tolerance", help="allowed slowdown against the baseline, as a fraction", default=0.25, type=float)
+    parser.add_argument("--codegen-target", help="minimum Rust codegen throughput, in MB/s", default=CODEGEN_TARGET, type=float)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        (synthetic_tilegrid, synthetic_romdb) = synthetic_inputs()
+        tilegrid_file = args.tilegrid
+        if tilegrid_file is None:
+            tilegrid_file = os.path.join(workdir, 'tilegrid.json')
+            with open(tilegrid_file, "w") as f:
+                f.write(synthetic_tilegrid)
+        romdb_file = args.romdb
+        if romdb_file is None:
+            romdb_file = os.path.join(workdir, 'rom.db')
+            with open(romdb_file, "w") as f:
+                f.write(synthetic_romdb)
+        (results, throughput) = run(tilegrid_file, args.part, args.segbits, romdb_file, args.repeat, workdir)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    regressions = []
+    print("{:16} {:>12} {:>12} {:>8}".format("stage", "time (ms)", "baseline", "ratio"))
+    for (stage, seconds) in results.items():
+        if baseline is not None and stage in baseline:
+            ratio = seconds / baseline[stage]
+            print("{:16} {:12.3f} {:12.3f} {:8.2f}".format(stage, seconds * 1000, baseline[stage] * 1000, ratio))
+            if ratio > 1 + args.tolerance:
+                regressions.append(stage)
+        else:
+            print("{:16} {:12.3f}".format(stage, seconds * 1000))
+    for (name, value) in throughput.items():
+        print("{}: {:.1f}".format(name, value))
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if throughput['rust-codegen MB/s'] < args.codegen_target:
+        regressions.append('rust-codegen (below {:.1f} MB/s)'.format(args.codegen_target))
+
+    if len(regressions) != 0:
+        print("regression against baseline in: {}".format(", ".join(regressions)))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
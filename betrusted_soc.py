@@ -62,6 +62,8 @@ from gateware.keyrom import KeyRom
 from valentyusb.usbcore.cpu.eptri import TriEndpointInterface
 from valentyusb.usbcore.io import IoBuf
 
+import key2bits
+
 # IOs ----------------------------------------------------------------------------------------------
 
 _io_pvt = [   # PVT-generation I/Os
@@ -436,7 +438,7 @@ _io_uart_debug_swapped = [
 # Platform -----------------------------------------------------------------------------------------
 
 class Platform(XilinxPlatform):
-    def __init__(self, io, toolchain="vivado", programmer="vivado", part="50", encrypt=False, make_mod=False, bbram=False, strategy='default'):
+    def __init__(self, io, toolchain="vivado", programmer="vivado", part="50", encrypt=False, make_mod=False, bbram=False, strategy='default', keyrom_geometry=key2bits.DEFAULT_GEOMETRY):
         part = "xc7s" + part + "-csga324-1il"
         XilinxPlatform.__init__(self, part, io, toolchain=toolchain)
 
@@ -482,18 +484,7 @@ class Platform(XilinxPlatform):
         if make_mod:
             # build a version of the bitstream with a different INIT value for the ROM lut, so the offset frame can
             # be discovered by diffing
-            for bit in range(0, 32):
-                for lut in range(4):
-                    if lut == 0:
-                        lutname = 'A'
-                    elif lut == 1:
-                        lutname = 'B'
-                    elif lut == 2:
-                        lutname = 'C'
-                    else:
-                        lutname = 'D'
-
-                    self.toolchain.additional_commands += ["set_property INIT 64'hA6C355555555A6C3 [get_cells KEYROM" + str(bit) + lutname + "]"]
+            self.toolchain.additional_commands += keyrom_geometry.mod_init_commands()
 
             self.toolchain.additional_commands += ["write_bitstream -bin_file -force top-mod.bit"]
 
@@ -1962,6 +1953,9 @@ def main():
     parser.add_argument(
         "--simple-boot", help="Fall back to the simple, unsigned bootloader", default=False, action="store_true",
     )
+    parser.add_argument(
+        "--make-mod", help="Also build top-mod.bit with the key ROM INITs overridden, and check rom.db against it. Needs an unencrypted build.", default=False, action="store_true",
+    )
 
     ##### extract user arguments
     args = parser.parse_args()
@@ -2024,7 +2018,7 @@ def main():
 
     ##### second pass to build the actual chip. Note any changes below need to be reflected into the first pass...might be a good idea to modularize that
     ##### setup platform
-    platform = Platform(io, encrypt=encrypt, bbram=bbram, strategy=args.strategy)
+    platform = Platform(io, encrypt=encrypt, bbram=bbram, strategy=args.strategy, make_mod=args.make_mod)
     # _io_uart_debug wires debug bridge to Rpi; _io_uart_debug_swapped wires console to Rpi
     platform.add_extension(_io_uart_debug_swapped)
 
@@ -2041,6 +2035,17 @@ def main():
 
     ##### post-build routines
     soc.do_exit(vns)
+
+    # the key ROM LUT placement can move with any change to the design, so re-derive it from the
+    # make_mod bitstream and make sure rom.db still describes it
+    if args.make_mod and compile_gateware:
+        if encrypt:
+            print("Bitstreams are encrypted, can't check rom.db against top-mod.bit; build without -e to check it.")
+        else:
+            if subprocess.call([sys.executable, './explorebits.py', 'build/gateware/betrusted_soc.bit', 'build/gateware/top-mod.bit',
+                                '-v', 'build/gateware/betrusted_soc.v', '--check', 'rom.db']) != 0:
+                print("rom.db does not match the key ROM placement in this build; regenerate it with explorebits.py -o rom.db")
+                return 1
     lxsocdoc.generate_docs(soc, "build/documentation", note_pulses=True, sphinx_extensions=['sphinx_math_dollar', 'sphinx.ext.mathjax'],
             sphinx_extra_config=r"""
 mathjax_config = {
@@ -2051,11 +2056,20 @@ mathjax_config = {
 }""")
 
     # generate the rom-inject library code
+    # the key ROM patch plan doesn't depend on the key, so it is derived once (or loaded from
+    # build/key2bits.plan if rom.db and the databases haven't changed) and shared by lib.rs and
+    # keystore.patch. lib.rs is only rewritten if it changed, so an unchanged key ROM doesn't force
+    # a rebuild of everything downstream of rom-inject
     if ~args.document_only:
         if not os.path.exists('fw/rom-inject/src'): # make rom-inject/src if it doesn't exist, e.g. on clean checkout
             os.mkdir('fw/rom-inject/src')
-        with open('fw/rom-inject/src/lib.rs', 'w+') as libfile:
-            subprocess.call([sys.executable, './key2bits.py', '-c', '-kkeystore.bin', '-rrom.db'], stdout=libfile)
+        try:
+            keyrom_plan = key2bits.load_plan('rom.db', plan_file=key2bits.DEFAULT_PLAN)
+        except key2bits.RomDbError as e:
+            # a bad rom.db would otherwise seal a corrupted key into the bitstream
+            print(e)
+            return 1
+        key2bits.build_output('fw/rom-inject/src/lib.rs', 'rust', 'keystore.bin', keyrom_plan)
 
     # now re-encrypt the binary if needed
     if encrypt and not args.document_only:
@@ -2068,18 +2082,29 @@ mathjax_config = {
             subprocess.call([sys.executable, './gen_keyrom.py', '--efuse-key', args.encrypt, '--dev-pubkey', './devkey/dev-x509.crt', '--output', 'keystore.bin'])
 
             print('Found keystore.bin, patching bitstream to contain specified keystore values.')
-            with open('keystore.patch', 'w') as patchfile:
-                subprocess.call([sys.executable, './key2bits.py', '-kkeystore.bin', '-rrom.db'], stdout=patchfile)
-                keystore_args = '-pkeystore.patch'
-                if bbram:
-                    enc = [sys.executable, 'deps/encrypt-bitstream-python/encrypt-bitstream.py', '--bbram','-fbuild/gateware/betrusted_soc.bin', '-idummy.nky', '-k' + args.encrypt, '-obuild/gateware/encrypted'] + [keystore_args]
-                else:
-                    enc = [sys.executable, 'deps/encrypt-bitstream-python/encrypt-bitstream.py', '-fbuild/gateware/betrusted_soc.bin', '-idummy.nky', '-k' + args.encrypt, '-obuild/gateware/encrypted'] + [keystore_args]
+            key2bits.build_output('keystore.patch', 'text', 'keystore.bin', keyrom_plan)
+            keystore_args = '-pkeystore.patch'
+            if bbram:
+                enc = [sys.executable, 'deps/encrypt-bitstream-python/encrypt-bitstream.py', '--bbram','-fbuild/gateware/betrusted_soc.bin', '-idummy.nky', '-k' + args.encrypt, '-obuild/gateware/encrypted'] + [keystore_args]
+            else:
+                enc = [sys.executable, 'deps/encrypt-bitstream-python/encrypt-bitstream.py', '-fbuild/gateware/betrusted_soc.bin', '-idummy.nky', '-k' + args.encrypt, '-obuild/gateware/encrypted'] + [keystore_args]
 
             subprocess.call(enc)
 
-            pad = [sys.executable, './append_csr.py', '-bbuild/gateware/encrypted.bin', '-cbuild/csr.csv', '-obuild/gateware/soc_csr.bin']
-            subprocess.call(pad)
+            # run in-process, so the image metadata shares this build's git queries (see gitinfo.py);
+            # imported here because the signing libraries are only needed for encrypted builds
+            import append_csr
+            # append_csr.py reports its errors by exiting, and a failed git query or git metadata
+            # it can't use (e.g. no tags) raises; either fails this build rather than unwinding through it
+            try:
+                append_csr.main(['-bbuild/gateware/encrypted.bin', '-cbuild/csr.csv', '-obuild/gateware/soc_csr.bin'])
+            except (subprocess.CalledProcessError, ValueError) as e:
+                print('append_csr: {}'.format(e))
+                return 1
+            except SystemExit as e:
+                if e.code:
+                    print('append_csr: failed to write build/gateware/soc_csr.bin')
+                    return 1
         else:
             print('Specified key file {} does not exist'.format(args.encrypt))
             return 1
@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+
+"""
+Differential bitstream explorer: locate the key ROM LUTs, and regenerate or check rom.db.
+
+Building with make_mod (see Platform in betrusted_soc.py) writes a second bitstream,
+top-mod.bit, in which the INIT of every KEYROM LUT is overridden with key2bits.MOD_INIT.
+The two bitstreams differ only in those LUTs, so diffing them finds every ROM LUT:
+
+1. Both bitstreams are memory-mapped, and their FDRI frame data is XORed word by word
+   (over NumPy views when NumPy is available) to get the changed (frame, word) positions.
+2. Each changed word is mapped back to the CLB tile that owns it: a CLB tile's frames are
+   contiguous in the framestream starting at its base frame address, so a bisect over the
+   translated base addresses of all CLB columns, plus the tile word offset, finds it.
+3. For every LUT of the candidate tiles, the INIT value is read out of both bitstreams
+   through the segbits database. The LUTs whose INIT changed are the ROM LUTs.
+4. The original INIT of each ROM LUT identifies its KEYROM<bit><stripe> cell, by matching
+   against the cell INIT values of the design: from the generated Verilog (build/gateware/
+   betrusted_soc.v), or computed from the key ROM contents the bitstream was built with.
+
+The result is written out as rom.db, or compared against an existing rom.db with --check, in
+which case a mismatch fails the run. Only the placement (data bit, stripe, slice, BEL) is
+compared; the INIT column of rom.db is for reference only.
+"""
+
+import argparse
+import bisect
+import mmap
+import re
+import struct
+import sys
+
+import key2bits
+import xc7bitstream
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CLB_FRAMES = 36  # frames per CLB_IO_CLK column
+CLB_WORDS = 2    # words per CLB tile in each frame
+DEFAULT_VERILOG = "build/gateware/betrusted_soc.v"
+
+"""
+Diff the frame data of two bitstreams of the same device. Returns a list of (framestream
+position, word offset, xor of the two words), in framestream order.
+"""
+def diff_frames(original, modified, original_layout, modified_layout):
+    for layout in (original_layout, modified_layout):
+        if layout.encrypted:
+            raise ValueError("bitstream is encrypted, diff the unencrypted bitstreams")
+    (original_offset, count) = original_layout.frame_data()
+    (modified_offset, modified_count) = modified_layout.frame_data()
+    if count != modified_count:
+        raise ValueError("bitstreams have different amounts of frame data, are they for the same device?")
+
+    if np is not None:
+        a = np.frombuffer(original, dtype='>u4', count=count, offset=original_offset)
+        b = np.frombuffer(modified, dtype='>u4', count=count, offset=modified_offset)
+        xor = a ^ b
+        changed = np.flatnonzero(xor)
+        return [(int(index) // xc7bitstream.FRAME_WORDS, int(index) % xc7bitstream.FRAME_WORDS, int(xor[index]))
+                for index in changed]
+
+    # compare a frame at a time, and only look at the words of frames that differ
+    diffs = []
+    frame_bytes = xc7bitstream.FRAME_WORDS * 4
+    for frame in range(count // xc7bitstream.FRAME_WORDS):
+        a_offset = original_offset + frame * frame_bytes
+        b_offset = modified_offset + frame * frame_bytes
+        a = original[a_offset:a_offset + frame_bytes]
+        b = modified[b_offset:b_offset + frame_bytes]
+        if a == b:
+            continue
+        for (word, (x, y)) in enumerate(zip(struct.iter_unpack('>I', a), struct.iter_unpack('>I', b))):
+            if x != y:
+                diffs.append((frame, word, x[0] ^ y[0]))
+    return diffs
+
+"""
+Locates the CLB tile that owns a framestream word. Tiles are grouped by (base frame address,
+word offset); the base frame addresses are translated to framestream positions once, and
+kept sorted for a bisect.
+"""
+class TileLocator:
+    def __init__(self, part):
+        self.part = part
+        self.tiles = {}
+        for (name, (tile_type, baseaddr, offset)) in part.slices.items():
+            self.tiles.setdefault((baseaddr, offset), []).append(name)
+        baseaddrs = sorted(set(baseaddr for (baseaddr, offset) in self.tiles))
+        positions = part.framestream.translate_many(baseaddrs)
+        columns = sorted(zip(positions, baseaddrs))
+        self.positions = [position for (position, baseaddr) in columns]
+        self.baseaddrs = [baseaddr for (position, baseaddr) in columns]
+
+    # the slices of the tile holding a (framestream position, word offset), or an empty list
+    def slices_at(self, position, word):
+        index = bisect.bisect_right(self.positions, position) - 1
+        if index < 0 or position >= self.positions[index] + CLB_FRAMES:
+            return []
+        baseaddr = self.baseaddrs[index]
+        slices = []
+        for offset in range(word - CLB_WORDS + 1, word + 1):
+            slices += self.tiles.get((baseaddr, offset), [])
+        return slices
+
+# read a LUT INIT value out of a bitstream, given the locations from key2bits.lut_init_bits()
+def read_init(data, layout, positions, init_bits):
+    init = 0
+    for (init_bit, ((frameaddress, word, bit), position)) in enumerate(zip(init_bits, positions)):
+        (value,) = struct.unpack_from('>I', data, layout.frame_word_offset(position, word))
+        init |= ((value >> bit) & 1) << init_bit
+    return init
+
+"""
+Find the LUTs that differ between the two bitstreams. Returns a list of (slice, BEL, original
+INIT, modified INIT), sorted by slice and BEL.
+"""
+def find_rom_luts(part, original, modified, geometry=key2bits.DEFAULT_GEOMETRY):
+    original_layout = xc7bitstream.BitstreamLayout(original)
+    modified_layout = xc7bitstream.BitstreamLayout(modified)
+    diffs = diff_frames(original, modified, original_layout, modified_layout)
+
+    locator = TileLocator(part)
+    candidates = set()
+    for (position, word, xor) in diffs:
+        candidates.update(locator.slices_at(position, word))
+
+    luts = []
+    for slice in sorted(candidates, key=key2bits.slice_key):
+        for bel in key2bits.SEGBITS_BELS:
+            init_bits = key2bits.lut_init_bits(part, slice, bel, geometry.lut_size)
+            positions = part.framestream.translate_many([frameaddress for (frameaddress, word, bit) in init_bits])
+            original_init = read_init(original, original_layout, positions, init_bits)
+            modified_init = read_init(modified, modified_layout, positions, init_bits)
+            if original_init != modified_init:
+                luts.append((slice, bel, original_init, modified_init))
+    return luts
+
+VERILOG_BASES = {'b': 2, 'o': 8, 'd': 10, 'h': 16}
+VERILOG_INIT = re.compile(r"\.INIT\(\s*\d*\s*'s?([bodhBODH])\s*([0-9a-fA-F_]+)\s*\)\s*\)\s*(KEYROM\d+[A-Z])\b")
+
+# cell name -> INIT, for the KEYROM cells instantiated in the generated Verilog. Migen writes
+# integer parameters as sized decimal literals (.INIT(64'd...)), other tools in hex or binary.
+def cell_inits_from_verilog(verilog):
+    inits = {}
+    for match in VERILOG_INIT.finditer(verilog):
+        inits[match.group(3)] = int(match.group(2).replace('_', ''), VERILOG_BASES[match.group(1).lower()])
+    return inits
+
+# cell name -> INIT, for a key ROM built with the given contents
+def cell_inits_from_keyrom(keyrom, geometry=key2bits.DEFAULT_GEOMETRY):
+    inits = {}
+    for bit in range(geometry.width):
+        for lut in range(geometry.luts):
+            init = 0
+            for adr in range(geometry.lut_size):
+                init |= ((keyrom[lut * geometry.lut_size + adr] >> bit) & 1) << adr
+            inits['KEYROM{}{}'.format(bit, geometry.stripe_name(lut))] = init
+    return inits
+
+"""
+Name the ROM LUTs by their original INIT. Returns a list of (data bit, stripe, slice, BEL, INIT)
+in data bit and stripe order, and a list of problems; the mapping is only usable if there are
+no problems.
+"""
+def match_cells(luts, cell_inits, geometry=key2bits.DEFAULT_GEOMETRY):
+    problems = []
+    mod_init = key2bits.MOD_INIT & ((1 << geometry.lut_size) - 1)
+    by_init = {}
+    for (cell, init) in cell_inits.items():
+        by_init.setdefault(init, []).append(cell)
+
+    entries = []
+    placed = set()
+    for (slice, bel, original_init, modified_init) in luts:
+        if modified_init != mod_init:
+            problems.append("{} {}: modified INIT is {:x}, not the make_mod pattern".format(slice, bel, modified_init))
+        cells = by_init.get(original_init, [])
+        if len(cells) != 1:
+            problems.append("{} {}: INIT {:x} matches {} KEYROM cells".format(slice, bel, original_init, len(cells)))
+            continue
+        match = re.match(r'KEYROM(\d+)([A-Z])$', cells[0])
+        (bit, stripe) = (int(match.group(1)), match.group(2))
+        placed.add(cells[0])
+        entries.append((bit, stripe, slice, bel, original_init))
+
+    for cell in geometry.cells():
+        if cell not in placed:
+            problems.append("{} was not found in the bitstream diff".format(cell))
+    entries.sort(key=lambda e: (e[0], e[1]))
+    return (entries, problems)
+
+def format_rom_db(entries, geometry=key2bits.DEFAULT_GEOMETRY):
+    lines = []
+    for (bit, stripe, slice, bel, init) in entries:
+        line = "KEYROM {} {} {} b'{:0{}x}'".format(bit, stripe, slice, init, geometry.lut_size // 4)
+        if bel != stripe + 'LUT':
+            line += " " + bel[0]
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+# compare the found placement against a parsed rom.db; returns a list of differences
+def check_rom_db(entries, rom_db, geometry=key2bits.DEFAULT_GEOMETRY):
+    found = set((bit, geometry.stripe_index(stripe), slice, bel) for (bit, stripe, slice, bel, init) in entries)
+    listed = set((bit, lut['lut'], lut['slice'], lut['bel']) for bit in range(len(rom_db)) for lut in rom_db[bit])
+    differences = []
+    for (bit, lut, slice, bel) in sorted(listed - found):
+        differences.append("rom.db places KEYROM{}{} at {} {}, not found there in the bitstream".format(bit, geometry.stripe_name(lut), slice, bel))
+    for (bit, lut, slice, bel) in sorted(found - listed):
+        differences.append("bitstream places KEYROM{}{} at {} {}, missing from rom.db".format(bit, geometry.stripe_name(lut), slice, bel))
+    return differences
+
+def main():
+    parser = argparse.ArgumentParser(description="Locate the key ROM LUTs by diffing a bitstream against its make_mod variant")
+    parser.add_argument("original", help="unencrypted bitstream, as built", type=str)
+    parser.add_argument("modified", help="the same bitstream with the KEYROM INITs overridden (top-mod.bit)", type=str)
+    parser.add_argument("-v", "--verilog", help="generated Verilog, to read the KEYROM cell INITs from", default=DEFAULT_VERILOG, type=str)
+    parser.add_argument("-k", "--keys", help="key ROM file the bitstream was built with, instead of --verilog", type=str)
+    parser.add_argument("-o", "--output", help="write the rom.db found to this file, defaults to stdout", type=str)
+    parser.add_argument("--check", help="compare against this rom.db instead of writing one, and fail on a mismatch", type=str)
+    parser.add_argument("-p", "--part", help="Part frame mapping file", default=key2bits.DEFAULT_PART, type=str)
+    parser.add_argument("-t", "--tilegrid", help="tilegrid file", default=key2bits.DEFAULT_TILEGRID, type=str)
+    parser.add_argument("-s", "--segbits", help="segbits file, or directory of segbits_<tile type>.db files", default=key2bits.DEFAULT_SEGBITS, type=str)
+    parser.add_argument("--cache", help="compiled database cache file", default=key2bits.DEFAULT_CACHE, type=str)
+    parser.add_argument("--rom-width", help="key ROM width in bits", default=key2bits.ROM_WIDTH, type=int)
+    parser.add_argument("--rom-depth", help="key ROM depth in words", default=key2bits.ROM_DEPTH, type=int)
+    parser.add_argument("--lut-size", help="addresses per ROM LUT", default=key2bits.LUT_SIZE, type=int, choices=[key2bits.LUT_SIZE])
+    args = parser.parse_args()
+
+    geometry = key2bits.RomGeometry(args.rom_width, args.rom_depth, args.lut_size).validate()
+    part = key2bits.load_part_database(args.tilegrid, args.part, args.segbits, args.cache)
+
+    with open(args.original, "rb") as f_original, open(args.modified, "rb") as f_modified:
+        with mmap.mmap(f_original.fileno(), 0, access=mmap.ACCESS_READ) as original, \
+             mmap.mmap(f_modified.fileno(), 0, access=mmap.ACCESS_READ) as modified:
+            luts = find_rom_luts(part, original, modified, geometry)
+
+    if args.keys is not None:
+        with open(args.keys, "rb") as f:
+            keyrom = key2bits.parse_keyrom(f.read())
+        if len(keyrom) != geometry.depth:
+            print("key ROM file {} is not {} words long".format(args.keys, geometry.depth))
+            return 1
+        cell_inits = cell_inits_from_keyrom(keyrom, geometry)
+    else:
+        with open(args.verilog, "r") as f:
+            cell_inits = cell_inits_from_verilog(f.read())
+        if len(cell_inits) == 0:
+            print("error: no KEYROM cell INITs found in {}".format(args.verilog), file=sys.stderr)
+            return 1
+
+    (entries, problems) = match_cells(luts, cell_inits, geometry)
+    for problem in problems:
+        print("error: " + problem, file=sys.stderr)
+    if len(problems) != 0:
+        return 1
+
+    if args.check is not None:
+        try:
+            rom_db = key2bits.read_rom_db(args.check, geometry)
+        except key2bits.RomDbError as e:
+            for problem in e.problems:
+                print("error: {}: {}".format(args.check, problem), file=sys.stderr)
+            return 1
+        differences = check_rom_db(entries, rom_db, geometry)
+        for difference in differences:
+            print("error: " + difference, file=sys.stderr)
+        if len(differences) != 0:
+            return 1
+        print("{} matches the bitstream: {} ROM LUTs".format(args.check, len(entries)))
+        return 0
+
+    if args.output is None:
+        sys.stdout.write(format_rom_db(entries, geometry))
+    else:
+        with open(args.output, "w") as f:
+            f.write(format_rom_db(entries, geometry))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
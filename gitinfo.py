@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+"""
+Git metadata for build records: the tags and revision of HEAD, its log entry, and the working
+tree status, as recorded in the SoC image metadata and CSV appendix by append_csr.py.
+
+A lookup runs two git commands, started together so they overlap:
+
+  git log -1 --name-status  with a format that also carries the commit hash and both
+                            describe strings (%(describe), which needs git 2.35 or newer)
+  git status --porcelain=v2 --branch
+
+The tags field is what git describe --tags prints, and rev what git describe --long --always
+prints, derived from the plain describe string and the abbreviated hash. The log entry is
+rebuilt in git log's default (medium) layout, and the status is reduced to the lines of
+git status output that the metadata keeps: "On branch" and the "modified:" entries, in the
+order and spelling git status prints them. git status still walks every submodule under deps/
+to see whether it is dirty, but it runs once per build rather than alongside three other
+queries.
+
+The result is cached in-process per repository and HEAD commit, so every consumer within a
+build (append_csr.py, including when it is run from betrusted_soc.py) shares one lookup.
+HEAD is read from .git directly to look up the cache; when that isn't possible (worktrees,
+submodules) the queries are simply rerun.
+"""
+
+import os
+import subprocess
+import sys
+from collections import namedtuple
+
+GitInfo = namedtuple('GitInfo', ['head', 'tags', 'rev', 'log', 'status'])
+
+# header fields ahead of the log message, each terminated by a NUL
+LOG_FIELDS = ['%H', '%h', '%p', '%aN <%aE>', '%ad', '%(describe:tags=true)', '%(describe)', '%B']
+LOG_QUERY = ["log", "-1", "--name-status", "--format=tformat:" + ''.join(f + '%x00' for f in LOG_FIELDS), "HEAD"]
+STATUS_QUERY = ["status", "--porcelain=v2", "--branch"]
+
+# git status pads the labels of tracked changes to 12 columns, and those of unmerged paths to 17
+MODIFIED = b'\tmodified:   '
+BOTH_MODIFIED = b'\tboth modified:   '
+
+_cache = {}
+
+# HEAD as a commit hash read from .git, or None if it can't be read without running git
+def read_head(repo='.'):
+    git_dir = os.path.join(repo, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head # detached
+        ref = head[len('ref: '):]
+        try:
+            with open(os.path.join(git_dir, ref), 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+        with open(os.path.join(git_dir, 'packed-refs'), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except OSError:
+        pass
+    return None
+
+# message lines as the medium layout prints them: indented by four, tabs expanded, trailing
+# whitespace dropped, and leading and trailing blank lines skipped
+def medium_message(message):
+    lines = [line.rstrip(b' \t\r') for line in message.split(b'\n')]
+    while len(lines) != 0 and len(lines[0]) == 0:
+        lines.pop(0)
+    while len(lines) != 0 and len(lines[-1]) == 0:
+        lines.pop()
+    return b''.join(b'    ' + line.expandtabs(8) + b'\n' for line in lines)
+
+# (head, tags, rev, log) from the output of LOG_QUERY
+def parse_log(out):
+    fields = out.split(b'\0', len(LOG_FIELDS))
+    if len(fields) != len(LOG_FIELDS) + 1:
+        raise ValueError("unexpected git log output: {!r}".format(out[:80]))
+    (head, abbrev, parents, author, date, tags, describe, message, name_status) = fields
+    if tags.startswith(b'%(') or describe.startswith(b'%('):
+        raise ValueError("git 2.35 or newer is needed to describe HEAD from git log")
+    if len(tags) == 0:
+        raise ValueError("no tags can describe HEAD {}".format(head.decode('ascii')))
+
+    # describe --long --always: the hash alone without an annotated tag, and a count of 0 on one
+    if len(describe) == 0:
+        rev = abbrev
+    elif describe.endswith(b'-g' + abbrev):
+        rev = describe
+    else:
+        rev = describe + b'-0-g' + abbrev
+
+    log = b'commit ' + head + b'\n'
+    if len(parents.split()) > 1:
+        log += b'Merge: ' + parents + b'\n'
+    log += b'Author: ' + author + b'\nDate:   ' + date + b'\n\n' + medium_message(message)
+    name_status = name_status[1:] # the newline ending the format
+    if len(name_status) != 0:
+        log += name_status
+    return (head.decode('ascii'), tags + b'\n', rev + b'\n', log)
+
+# the "On branch" and "modified:" lines of git status, from the output of STATUS_QUERY
+def parse_status(out):
+    branch = []
+    updated = []
+    unmerged = []
+    changed = []
+    for line in out.splitlines():
+        if line.startswith(b'# branch.head '):
+            name = line[len(b'# branch.head '):]
+            if name != b'(detached)':
+                branch.append(b'On branch ' + name + b'\n')
+        elif line.startswith(b'1 ') or line.startswith(b'2 '):
+            fields = line.split(b' ', 8 if line.startswith(b'1 ') else 9)
+            (xy, submodule, path) = (fields[1], fields[2], fields[-1].split(b'\t')[0])
+            if xy[0:1] == b'M':
+                updated.append(MODIFIED + path + b'\n')
+            if xy[1:2] == b'M':
+                # what changed in a submodule is only shown for the working tree
+                extra = []
+                if submodule[1:2] == b'C':
+                    extra.append(b'new commits')
+                if submodule[2:3] == b'M':
+                    extra.append(b'modified content')
+                if submodule[3:4] == b'U':
+                    extra.append(b'untracked content')
+                if len(extra) != 0:
+                    path += b' (' + b', '.join(extra) + b')'
+                changed.append(MODIFIED + path + b'\n')
+        elif line.startswith(b'u '):
+            fields = line.split(b' ', 10)
+            if fields[1] == b'UU':
+                unmerged.append(BOTH_MODIFIED + fields[-1] + b'\n')
+    return b''.join(branch + updated + unmerged + changed)
+
+def git_info(repo='.'):
+    repo_path = os.path.realpath(repo)
+    head = read_head(repo)
+    if head is not None and (repo_path, head) in _cache:
+        return _cache[(repo_path, head)]
+
+    processes = []
+    for args in (LOG_QUERY, STATUS_QUERY):
+        processes.append(subprocess.Popen(["git"] + args, cwd=repo, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+    outputs = []
+    failed = None
+    for (args, process) in zip((LOG_QUERY, STATUS_QUERY), processes):
+        (out, err) = process.communicate()
+        if process.returncode != 0:
+            sys.stderr.write(err.decode('utf-8', 'replace'))
+            if failed is None:
+                failed = subprocess.CalledProcessError(process.returncode, ["git"] + args, out, err)
+        outputs.append(out)
+    if failed is not None:
+        raise failed
+
+    (head, tags, rev, log) = parse_log(outputs[0])
+    info = GitInfo(head=head, tags=tags, rev=rev, log=log, status=parse_status(outputs[1]))
+    _cache[(repo_path, head)] = info
+    return info
+
+if __name__ == "__main__":
+    info = git_info()
+    for field in GitInfo._fields:
+        value = getattr(info, field)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        sys.stdout.write("{}:\n{}\n".format(field, value.rstrip('\n')))
@@ -19,7 +19,9 @@ There are two types of output from this program:
 
 1. An ascii file containing a set of (offset, byte) pairs that specify the patching offset, in bytes, from the
 start of the "type2" frames within the bitstream to insert the ROM pattern. This can be paired wth another
-utility that applies the patch thus resulting in a .bin file that can be burned into an FPGA.
+utility that applies the patch thus resulting in a .bin file that can be burned into an FPGA. With
+--patch-format binary the same patches are written in the compact, sorted binary format described in
+patchfile.py.
 
 2. A Rust function which reads in the key data from a "key: [u32; 256]" array, and given an offset
 from the start of a "type2" config frame run return either None for no patching, or the byte to replace at
@@ -33,6 +35,28 @@ By allowing the striping of the key data to be specified in a rom.db file, the b
 can be updated in the case that later on the position of the key LUTs need to be changed for better fitting
 into the FPGA.
 
+Parsing the prjxray databases is the slowest part of a run, so the reduced databases are compiled
+into a binary cache (build/key2bits.cache by default) keyed by the hashes of the source files. The
+cache is rebuilt automatically when a source changes; --compile-db rebuilds it explicitly, and
+--no-cache bypasses it.
+
+The mapping of key bits to bitstream bits does not depend on the key, so it is saved as a
+patch plan (--plan, build/key2bits.plan by default). The plan is derived once per rom.db and
+reused for every key sealed against the same bitstream, skipping the database load entirely.
+
+With --bitstream, the patch words are written directly into a memory-mapped copy of an
+unencrypted bitstream (see xc7bitstream.py), instead of being printed. --extract does the
+reverse: it reads the key ROM back out of a patched bitstream and compares it with --keys.
+
+# Library use
+
+key2bits can also be imported, which is how betrusted_soc.py uses it. load_plan() derives (or
+loads) the patch plan once; read_keyrom() or parse_keyrom() read a key; and write_patches(),
+write_rust() and patch_bitstream() produce the outputs. build_output() renders one output file
+from a loaded plan and a key file, and only rewrites the file if it changed (see "Output
+files" below). Every file-based loader has a parse_* or from_bytes
+counterpart taking the file contents instead.
+
 # rom.db format
 
 KEYROM 0 A SLICE_X36Y50 b'5bbb150b97ae3f53'
@@ -47,13 +71,20 @@ KEYROM 1 B SLICE_X37Y50 b'38b963e9309f90a9'
   |    |______________________________________  which bit of the 32-bit bus this LUT maps to
   |___________________________________________  root name of the cells
 
+In a ROM deeper than four LUTs per bit, the stripe letters run on past D, and a LUT's BEL can no longer be
+its stripe letter; such lines carry the BEL as a sixth field: "KEYROM 0 E SLICE_X36Y51 b'...' A".
+
+rom.db is generated, or checked against a build, by explorebits.py, which diffs a bitstream against its
+make_mod variant.
+
 the SLICE maps to one of two sites in a CLBLL_L block; even slices to "X0", and odd slices to "X1" in
 the segbits file.
 
 
 # MAPPING KEY->LUT
 
-The ROM is implemented in hardware as a 256 entry x 32-bit wide ROM. There are 128 ROM LUTs, and each ROM LUT
+By default, the ROM is implemented in hardware as a 256 entry x 32-bit wide ROM (see "Key ROM geometry"
+below for other sizes). There are 128 ROM LUTs, and each ROM LUT
 maps to one bit of the key ROM. So, KEYROM0* is bit 0, KEYROM1* is bit 1, and so forth. The KEYROMs are further
 broken down into A-D BEL positions, with "A" position corresponding to bits [63:0], "B" to bits [127:64],
 "C" to bits [191:128], and "D" to bits [255:192] (note that this assumes in rom.db that the BEL mappings
@@ -111,7 +142,9 @@ refers to the address of a given frame, and the "offset" is the index into the f
 striping of the CLB data starts.
 
 The segbits file then locates a bit describing a CLB element based on a "function_bit" notation.
-From the segbits file (all others ignored):
+There is one segbits file per tile type (segbits_clbll_l.db, segbits_clblm_r.db, ...), and the tile
+type of each slice comes from the "type" field of its tilegrid entry. From the segbits file (all others
+ignored):
 
 CLBLL_L.SLICEL_X0.ALUT.INIT[00] 32_15
 CLBLL_L.SLICEL_X0.ALUT.INIT[01] 33_15
@@ -149,10 +182,29 @@ format).
 """
 
 import argparse
+import array
+import bisect
+import concurrent.futures
+import hashlib
+import io
 import json
+import mmap
 import pdb
 import re
 import os
+import shutil
+import struct
+import sys
+import time
+from collections import namedtuple
+
+import patchfile
+import xc7bitstream
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # numpy is optional, batch translation falls back to pure Python
 
 def sum_columns(column_dict, stop):
     sum = 0
@@ -226,290 +278,1445 @@ def address_to_framestream(db, address):
 
     return framestream_offset + minor_address
 
-def auto_int(x):
-    return int(x, 0)
+"""
+Precomputed framestream index.
 
-def main():
+address_to_framestream() above re-walks the part database for every frame address it
+translates. The walk only depends on the (block type, clock region, row) fields of the
+address -- 9 bits, so 512 possible outcomes -- plus a prefix sum over the columns of at
+most one configuration bus. FramestreamIndex resolves all 512 walks once, and stores a
+1024-entry column prefix sum for every configuration bus, so that a translation becomes:
 
-    parser = argparse.ArgumentParser(description="key file to bitstream patcher")
-    parser.add_argument("-k", "--keys", help="key ROM file", default="key.bin", type=str)
-    parser.add_argument("-p", "--part", help="Part frame mapping file", default="db/xc7s50csga324-1il.json", type=str)
-    parser.add_argument("-t", "--tilegrid", help="tilegrid file", default="db/tilegrid.json", type=str)
-    parser.add_argument("-r", "--romdb", help="ROM LUT mapping database", default="rom.db", type=str)
-    parser.add_argument("-s", "--segbits", help="segbits file", default="db/segbits_clbll_l.db", type=str)
-    parser.add_argument("-c", "--code", help="Output is rust code, not patch stream", default=False, action="store_true")
-    args = parser.parse_args()
+  framestream = base[bt/region/row] + prefix[bus[bt/region/row]][column] + minor
 
-    #-----------  READ IN DATABASES ------------
+The index reproduces address_to_framestream() exactly, including its handling of buses
+that are missing from the part database.
+"""
+BLOCK_TYPES = ['CLB_IO_CLK', 'BLOCK_RAM', 'CFG_CLB']
+COLUMN_ADDRESSES = 1024  # the column field of a frame address is 10 bits wide
+WALK_KEYS = 512          # block type (3 bits), clock region (1 bit) and row (5 bits)
+
+class FramestreamIndex:
+    def __init__(self, base, bus, prefix):
+        # base[key] and bus[key] are indexed by bits [25:17] of a frame address; prefix[bus]
+        # is a 1024-entry column prefix sum, with prefix[0] all zero for "no partial bus"
+        self.base = base
+        self.bus = bus
+        self.prefix = prefix
+
+        if np is not None:
+            self.np_base = np.array(self.base, dtype=np.int64)
+            self.np_bus = np.array(self.bus, dtype=np.int64)
+            self.np_prefix = np.array(self.prefix, dtype=np.int64)
+
+    @classmethod
+    def from_buses(cls, buses):
+        # buses is the part database flattened in walk order: buses[region][row][bt] is
+        # either None (bus not present) or a list of (column, frame_count) pairs
+        prefixes = [[0] * COLUMN_ADDRESSES]
+        layout = []
+        for rows in buses:
+            layout_rows = []
+            for row in rows:
+                layout_bts = []
+                for columns in row:
+                    if columns is None:
+                        layout_bts.append(None)
+                        continue
+                    counts = [0] * COLUMN_ADDRESSES
+                    for (col, frame_count) in columns:
+                        counts[col] += frame_count
+                    prefix = [0] * COLUMN_ADDRESSES
+                    total = 0
+                    for col in range(COLUMN_ADDRESSES):
+                        prefix[col] = total
+                        total += counts[col]
+                    prefixes.append(prefix)
+                    layout_bts.append((len(prefixes) - 1, total))
+                layout_rows.append(layout_bts)
+            layout.append(layout_rows)
+
+        base = [0] * WALK_KEYS
+        bus = [0] * WALK_KEYS
+        for key in range(WALK_KEYS):
+            base[key], bus[key] = cls._resolve(layout, key)
+        return cls(base, bus, prefixes)
+
+    @classmethod
+    def from_part_db(cls, db):
+        buses = []
+        for region in range(len(db['global_clock_regions'])):
+            if region == 0:
+                clock_region = 'top'
+            else:
+                clock_region = 'bottom'
+            rows = db['global_clock_regions'][clock_region]['rows']
+            region_buses = []
+            for row in range(len(rows)):
+                row_buses = []
+                for block_type in BLOCK_TYPES:
+                    try:
+                        columns = rows[str(row)]['configuration_buses'][block_type]['configuration_columns']
+                    except KeyError:
+                        row_buses.append(None)
+                        continue
+                    row_buses.append([(int(col), int(columns[col]['frame_count'])) for col in columns])
+                region_buses.append(row_buses)
+            buses.append(region_buses)
+        return cls.from_buses(buses)
+
+    # mirrors the walk in address_to_framestream(), with whole buses pre-summed
+    @staticmethod
+    def _resolve(layout, key):
+        row_address = key & 0x1F
+        clock_region_code = (key >> 5) & 0x1
+        block_type_code = (key >> 6) & 7
+
+        region_met = False
+        row_met = False
+        type_met = False
+        base = 0
+        for region in range(len(layout)):
+            if region >= clock_region_code:
+                region_met = True
+            if type_met:
+                break
+            for row in range(len(layout[region])):
+                if region_met and (row >= row_address):
+                    row_met = True
+                if type_met:
+                    break
+                for bt in range(len(layout[region][row])):
+                    if (bt >= block_type_code) and region_met and row_met:
+                        type_met = True
+                    bus = layout[region][row][bt]
+                    if bus is None:
+                        continue
+                    if type_met:
+                        return base, bus[0]
+                    base += bus[1]
+        return base, 0
+
+    def translate(self, address):
+        key = (address >> 17) & 0x1FF
+        return self.base[key] + self.prefix[self.bus[key]][(address >> 7) & 0x3FF] + (address & 0x7F)
+
+    # translate a batch of frame addresses in one pass; returns a list of framestream positions
+    def translate_many(self, addresses):
+        if np is None:
+            return [self.translate(address) for address in addresses]
+        addresses = np.asarray(addresses, dtype=np.int64)
+        keys = (addresses >> 17) & 0x1FF
+        positions = self.np_base[keys] + self.np_prefix[self.np_bus[keys], (addresses >> 7) & 0x3FF] + (addresses & 0x7F)
+        return positions.tolist()
+
+"""
+Database loading.
+
+The patcher only needs three things out of the prjxray databases:
+
+  slices:      SLICE name -> (tile type, CLB_IO_CLK base frame address, word offset), from tilegrid.json
+  segbits:     a SegbitsIndex, (tile type, site parity 'X0'/'X1', LUT BEL, INIT bit) -> (function index, bit offset)
+  framestream: a FramestreamIndex built from the part json
+
+PartDatabase holds these three. The slices and the framestream index are either parsed from
+the source files or loaded from a compiled cache (see below); the segbits are loaded lazily,
+one prjxray segbits_<tile type>.db file per CLB tile type that the ROM is actually placed in.
+"""
+SEGBITS_SITES = ['X0', 'X1']
+SEGBITS_BELS = ['ALUT', 'BLUT', 'CLUT', 'DLUT']
+SEGBITS_TILE_TYPES = ['CLBLL_L', 'CLBLL_R', 'CLBLM_L', 'CLBLM_R']
+
+# tilegrid is the contents of tilegrid.json, as str or bytes
+def parse_tilegrid(tilegrid):
     slice_db = {}
-    with open(args.tilegrid, "r") as f:
-        json_file = f.read()
-        db = json.loads(json_file)
-        for key in db:
-            entry = db[key]
-            if 'SLICE' in str(entry['sites']):
-                for slices in entry['sites']:
-                    slice_db[slices] = entry['bits']['CLB_IO_CLK']
-    # slice_db is now a lookup for SLICE locations to addresses and offsets
-
-    with open(args.part, "r") as f:
-        partfile = f.read()
-        part_db = json.loads(partfile)
-    # part_db now contains the frame-to-bitstream position database
-
-    segbits = []
-    with open(args.segbits, "r") as f:
-        for line in f:
-            if line.startswith("CLBLL_L.SLICE") and "INIT[" in line:
-                segbits += [line]
-
-    segbits_db = {'X0': {'ALUT':[None]*64, 'BLUT':[None]*64, 'CLUT':[None]*64, 'DLUT':[None]*64},
-                  'X1': {'ALUT':[None]*64, 'BLUT':[None]*64, 'CLUT':[None]*64, 'DLUT':[None]*64},}
-    for line in segbits:
-        elements = re.split('[^a-zA-Z0-9]', line.split()[0])
-        bitlist = segbits_db[elements[3]][elements[4]]
-        bitlist[int(elements[6])] = line.split()[1].split('_')  # insert the function index + bit offset at the respective LUT entry
-    # segbits_db is now a lookup of a slice/lut position to a function index + bit offset
-
-    rom_db = [[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],[],]
-    with open(args.romdb, "r") as f:
-        for line in f:
-            items = line.split()
-            rom_db[int(items[1])] += [{'bel': items[2] + 'LUT', 'slice': items[3]}]
+    db = json.loads(tilegrid)
+    for key in db:
+        entry = db[key]
+        if 'SLICE' in str(entry['sites']) and 'CLB_IO_CLK' in entry['bits']:
+            for slices in entry['sites']:
+                bits = entry['bits']['CLB_IO_CLK']
+                slice_db[slices] = (entry['type'], int(bits['baseaddr'], 16), int(bits['offset']))
+    return slice_db
+
+def load_slice_db(tilegrid_file):
+    with open(tilegrid_file, "rb") as f:
+        return parse_tilegrid(f.read())
+
+SEGBITS_INIT = re.compile(r'^(\w+)\.SLICE[LM]_(X[01])\.([A-D]LUT)\.INIT\[(\d+)\]$')
+
+# segbits is the contents of a segbits .db file, as str or bytes; returns (tile type, site, BEL) -> 64 INIT bits
+def parse_segbits(segbits):
+    if isinstance(segbits, bytes):
+        segbits = segbits.decode('utf-8')
+    segbits_db = {}
+    for line in segbits.splitlines():
+        items = line.split()
+        if len(items) < 2 or "INIT[" not in items[0]:
+            continue
+        match = SEGBITS_INIT.match(items[0])
+        if match is None:
+            continue
+        (tile_type, site, bel, bit) = match.groups()
+        if (tile_type, site, bel) not in segbits_db:
+            segbits_db[(tile_type, site, bel)] = [None]*64
+        function_bit = items[1].split('_')
+        # insert the function index + bit offset at the respective LUT entry
+        segbits_db[(tile_type, site, bel)][int(bit)] = (int(function_bit[0]), int(function_bit[1]))
+    return segbits_db
+
+def load_segbits_db(segbits_file):
+    with open(segbits_file, "rb") as f:
+        return parse_segbits(f.read())
+
+# the prjxray segbits files that a --segbits file or directory stands for, existing ones only
+def segbits_files(segbits_path):
+    if os.path.isdir(segbits_path):
+        segbits_dir = segbits_path
+        files = []
+    else:
+        segbits_dir = os.path.dirname(segbits_path)
+        files = [segbits_path]
+    for tile_type in SEGBITS_TILE_TYPES:
+        path = os.path.join(segbits_dir, 'segbits_{}.db'.format(tile_type.lower()))
+        if os.path.isfile(path) and path not in files:
+            files.append(path)
+    return files
 
-    #-----------  READ IN KEY DATA ------------
+"""
+Segbits lookup across CLB tile types. The LUT INIT bits of each tile type are loaded on first
+use, from segbits_<tile type>.db next to the given segbits file (or in the given directory);
+lookups are then dictionary accesses.
+"""
+class SegbitsIndex:
+    def __init__(self, segbits_path=None, luts=None):
+        self.luts = {} if luts is None else dict(luts)
+        self.loaded = set(tile_type for (tile_type, site, bel) in self.luts)
+        # files still to be read: a given segbits file first, then the per tile type files
+        self.pending = []
+        self.segbits_dir = None
+        if segbits_path is not None:
+            if os.path.isdir(segbits_path):
+                self.segbits_dir = segbits_path
+            else:
+                self.segbits_dir = os.path.dirname(segbits_path)
+                self.pending.append(segbits_path)
+
+    def _merge(self, segbits_file):
+        segbits_db = load_segbits_db(segbits_file)
+        self.luts.update(segbits_db)
+        self.loaded.update(tile_type for (tile_type, site, bel) in segbits_db)
+
+    def load(self, tile_type):
+        while tile_type not in self.loaded and len(self.pending) != 0:
+            self._merge(self.pending.pop(0))
+        if tile_type in self.loaded:
+            return
+        if self.segbits_dir is None:
+            raise KeyError("no segbits loaded for tile type {}".format(tile_type))
+        segbits_file = os.path.join(self.segbits_dir, 'segbits_{}.db'.format(tile_type.lower()))
+        if not os.path.isfile(segbits_file):
+            raise KeyError("no segbits file for tile type {} (looked for {})".format(tile_type, segbits_file))
+        self._merge(segbits_file)
+        # a file without this tile type's LUTs still marks it loaded, so the lookup fails with a KeyError
+        self.loaded.add(tile_type)
+
+    # the 64 (function index, bit offset) pairs of one LUT's INIT bits
+    def lut(self, tile_type, site, bel):
+        self.load(tile_type)
+        if (tile_type, site, bel) not in self.luts:
+            raise KeyError("no segbits for {} {} {}".format(tile_type, site, bel))
+        return self.luts[(tile_type, site, bel)]
+
+    # key is (tile type, site, BEL, INIT bit)
+    def __getitem__(self, key):
+        (tile_type, site, bel, bit) = key
+        return self.lut(tile_type, site, bel)[bit]
+
+class PartDatabase:
+    def __init__(self, slices, segbits, framestream):
+        self.slices = slices
+        self.segbits = segbits
+        self.framestream = framestream
+
+    # build from the contents of the three database files, as str or bytes
+    @classmethod
+    def from_bytes(cls, tilegrid, part, segbits):
+        return cls(parse_tilegrid(tilegrid), SegbitsIndex(luts=parse_segbits(segbits)), FramestreamIndex.from_part_db(json.loads(part)))
+
+    @classmethod
+    def from_sources(cls, tilegrid_file, part_file, segbits_path):
+        with open(part_file, "r") as f:
+            part_db = json.load(f)
+        return cls(load_slice_db(tilegrid_file), SegbitsIndex(segbits_path), FramestreamIndex.from_part_db(part_db))
+
+"""
+Compiled database cache.
+
+Parsing tilegrid.json alone dominates the run time of key2bits, so the reduced slice and
+framestream databases can be compiled into a binary cache file. The cache is keyed by the
+SHA-256 of tilegrid.json and the part json and is rebuilt whenever either of them changes.
+The segbits files are small and loaded lazily, so they are not cached. All fields are
+little-endian:
+
+  header   magic 'K2BC', version u32, 2x 32-byte source hashes, slice count u32, bus count u32,
+           tile type count u32
+  types    tile type names, 16 bytes each, NUL padded
+  slices   keys u32[n] (x << 16 | y, sorted), base frame addresses u32[n], word offsets u32[n],
+           tile type indices u32[n]
+  walk     base u32[512], bus u32[512]
+  prefix   u32[buses][1024], the all-zero row 0 included
+
+The cache is memory-mapped on load. Slices are looked up with a binary search over the
+mapped key array, and the framestream prefix sums are used in place.
+"""
+CACHE_MAGIC = b'K2BC'
+CACHE_VERSION = 2
+CACHE_HEADER = struct.Struct('<4sI32s32sIII')
+CACHE_TILE_TYPE = struct.Struct('16s')
+
+def hash_files(*paths):
+    hashes = []
+    for path in paths:
+        with open(path, "rb") as f:
+            hashes.append(hashlib.sha256(f.read()).digest())
+    return hashes
+
+SLICE_NAME = re.compile(r'SLICE_X(\d+)Y(\d+)$')
+
+# raises KeyError for anything that isn't a SLICE_X<n>Y<n> name, as a missing slice would
+def slice_key(name):
+    match = SLICE_NAME.match(name)
+    if match is None or int(match.group(1)) > 0xFFFF or int(match.group(2)) > 0xFFFF:
+        raise KeyError(name)
+    return (int(match.group(1)) << 16) | int(match.group(2))
+
+def u32_view(buf, offset, count):
+    view = memoryview(buf)[offset:offset + count * 4]
+    if sys.byteorder == 'little':
+        return view.cast('I')
+    return struct.unpack('<{}I'.format(count), view)
+
+class SliceTable:
+    def __init__(self, keys, baseaddrs, offsets, types, tile_types):
+        self.keys = keys
+        self.baseaddrs = baseaddrs
+        self.offsets = offsets
+        self.types = types
+        self.tile_types = tile_types
+
+    def __getitem__(self, name):
+        key = slice_key(name)
+        index = bisect.bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            raise KeyError(name)
+        return (self.tile_types[self.types[index]], self.baseaddrs[index], self.offsets[index])
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.keys)
+
+    # (SLICE name, (tile type, base frame address, word offset)) for every slice, like dict.items()
+    def items(self):
+        for index in range(len(self.keys)):
+            key = self.keys[index]
+            yield ("SLICE_X{}Y{}".format(key >> 16, key & 0xFFFF),
+                   (self.tile_types[self.types[index]], self.baseaddrs[index], self.offsets[index]))
+
+def write_cache(cache_file, source_hashes, db):
+    slices = sorted((slice_key(name), db.slices[name]) for name in db.slices)
+    tile_types = sorted(set(s[1][0] for s in slices))
+    type_index = dict((tile_type, index) for (index, tile_type) in enumerate(tile_types))
+    out = bytearray(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, *source_hashes, len(slices),
+                                      len(db.framestream.prefix), len(tile_types)))
+    for tile_type in tile_types:
+        out += CACHE_TILE_TYPE.pack(tile_type.encode('ascii'))
+    out += struct.pack('<{}I'.format(len(slices)), *[s[0] for s in slices])
+    out += struct.pack('<{}I'.format(len(slices)), *[s[1][1] for s in slices])
+    out += struct.pack('<{}I'.format(len(slices)), *[s[1][2] for s in slices])
+    out += struct.pack('<{}I'.format(len(slices)), *[type_index[s[1][0]] for s in slices])
+    out += struct.pack('<{}I'.format(WALK_KEYS), *db.framestream.base)
+    out += struct.pack('<{}I'.format(WALK_KEYS), *db.framestream.bus)
+    for prefix in db.framestream.prefix:
+        out += struct.pack('<{}I'.format(COLUMN_ADDRESSES), *prefix)
+
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir != '':
+        os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_file + '.tmp', "wb") as f:
+        f.write(out)
+    os.replace(cache_file + '.tmp', cache_file)
+
+# returns None if the cache is missing, stale or from another cache version
+def read_cache(cache_file, source_hashes, segbits_path):
+    try:
+        with open(cache_file, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(buf) < CACHE_HEADER.size:
+        return None
+    (magic, version, h0, h1, n_slices, n_prefix, n_types) = CACHE_HEADER.unpack_from(buf, 0)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION or [h0, h1] != source_hashes:
+        return None
+
+    offset = CACHE_HEADER.size
+    tile_types = []
+    for i in range(n_types):
+        tile_types.append(CACHE_TILE_TYPE.unpack_from(buf, offset)[0].rstrip(b'\0').decode('ascii'))
+        offset += CACHE_TILE_TYPE.size
+    slices = SliceTable(u32_view(buf, offset, n_slices), u32_view(buf, offset + n_slices * 4, n_slices),
+                        u32_view(buf, offset + n_slices * 8, n_slices), u32_view(buf, offset + n_slices * 12, n_slices),
+                        tile_types)
+    offset += n_slices * 16
+    base = u32_view(buf, offset, WALK_KEYS)
+    bus = u32_view(buf, offset + WALK_KEYS * 4, WALK_KEYS)
+    offset += WALK_KEYS * 8
+    prefix = [u32_view(buf, offset + row * COLUMN_ADDRESSES * 4, COLUMN_ADDRESSES) for row in range(n_prefix)]
+    return PartDatabase(slices, SegbitsIndex(segbits_path), FramestreamIndex(base, bus, prefix))
+
+# load the databases through the cache, recompiling the cache if it is stale
+def load_part_database(tilegrid_file, part_file, segbits_path, cache_file=None):
+    if cache_file is None:
+        return PartDatabase.from_sources(tilegrid_file, part_file, segbits_path)
+    source_hashes = hash_files(tilegrid_file, part_file)
+    db = read_cache(cache_file, source_hashes, segbits_path)
+    if db is None:
+        db = PartDatabase.from_sources(tilegrid_file, part_file, segbits_path)
+        write_cache(cache_file, source_hashes, db)
+    return db
+
+"""
+Key ROM geometry.
+
+The key ROM is width bits wide and depth words deep, and is built from LUT ROMs of lut_size
+addresses each (64 for a LUT6). Every data bit is a column of depth / lut_size LUTs, each
+holding one lut_size-address stripe of that bit; the LUT for stripe n of data bit b is the
+cell KEYROM<b><letter>, with letter 'A' for stripe 0, 'B' for stripe 1, and so forth. The
+default is the 32 x 256 ROM in four LUT6s (A-D) per bit, one slice per bit.
+
+The geometry is described once here, and used by the patch plan derivation, the Rust code
+generation, and the INIT override bitstream (make_mod in betrusted_soc.py) used to find the
+ROM LUTs in the first place. Words are stored in 32-bit key ROM files and patch words, so
+the width is limited to 32. The LUTs must be LUT6s used as 64-address ROMs: a 32-address
+ROM would cover only half of each LUT's INIT, leaving every patch word partly unmapped, and
+the cells are LUT6 primitives with a 64-bit INIT regardless.
+"""
+ROM_WIDTH = 32
+ROM_DEPTH = 256
+LUT_SIZE = 64
+MOD_INIT = 0xA6C355555555A6C3 # a distinctive INIT pattern, for finding the ROM LUTs by diffing
+
+class RomGeometry(namedtuple('RomGeometry', ['width', 'depth', 'lut_size'])):
+    __slots__ = ()
+
+    def validate(self):
+        if not 0 < self.width <= 32:
+            raise ValueError("key ROM width must be 1-32 bits, not {}".format(self.width))
+        if self.lut_size != LUT_SIZE:
+            raise ValueError("LUT size must be {} addresses (a LUT6), not {}".format(LUT_SIZE, self.lut_size))
+        if self.depth <= 0 or self.depth % self.lut_size != 0 or self.luts > 26:
+            raise ValueError("key ROM depth must be a multiple of the LUT size, up to 26 LUTs deep")
+        return self
+
+    # number of LUTs per data bit
+    @property
+    def luts(self):
+        return self.depth // self.lut_size
+
+    def stripe_name(self, lut):
+        return chr(ord('A') + lut)
+
+    def stripe_index(self, name):
+        lut = ord(name[0]) - ord('A')
+        if len(name) != 1 or not 0 <= lut < self.luts:
+            raise ValueError("no ROM LUT stripe {} in a {}-deep key ROM".format(name, self.depth))
+        return lut
+
+    # the ROM LUT cell names, in data bit order and then stripe order
+    def cells(self):
+        return ['KEYROM{}{}'.format(bit, self.stripe_name(lut)) for bit in range(self.width) for lut in range(self.luts)]
+
+    # Vivado commands overriding every ROM LUT INIT with MOD_INIT
+    def mod_init_commands(self):
+        init = MOD_INIT & ((1 << self.lut_size) - 1)
+        return ["set_property INIT {}'h{:0{}X} [get_cells {}]".format(self.lut_size, init, self.lut_size // 4, cell)
+                for cell in self.cells()]
+
+DEFAULT_GEOMETRY = RomGeometry(ROM_WIDTH, ROM_DEPTH, LUT_SIZE)
+
+"""
+Patch plan.
+
+Working out which bitstream bits hold which key ROM bits does not depend on the key at all,
+only on rom.db and the databases. derive_plan() resolves this once into a PatchPlan:
+
+  positions: array of framestream positions, one per patched word
+  words:     array of word offsets within the frame, one per patched word
+  sources:   array of 32 flat key bit indices (address * width + data bit) per patched word,
+             LSB of the patch word first
+
+The patched words are sorted by frame address and then word offset. The plan only holds
+the patched words, so its size scales with the number of key bits rather than with the
+number of frames touched; iter_frames() gives the per-frame grouped view.
+
+A plan can be saved and reloaded, so provisioning many keys against one bitstream only pays
+for the derivation once. PatchPlan.apply() then turns a key into patch words by gathering
+bits through the precomputed source indices: with NumPy, as a single fancy-index of an
+(N_words x 32) index array into the unpacked key bit matrix, otherwise in pure Python.
+"""
+DEFAULT_ROMDB = "rom.db"
+DEFAULT_TILEGRID = "db/tilegrid.json"
+DEFAULT_PART = "db/xc7s50csga324-1il.json"
+DEFAULT_SEGBITS = "db/segbits_clbll_l.db"
+DEFAULT_CACHE = "build/key2bits.cache"
+DEFAULT_PLAN = "build/key2bits.plan"
+PLAN_MAGIC = b'K2BP'
+PLAN_VERSION = 2
+PLAN_HEADER = struct.Struct('<4sIII32sI')
+
+# rom_db is the contents of a rom.db file, as str; returns a list over the data bits of ROM LUT
+# entries, or raises a RomDbError listing the malformed lines
+def parse_rom_db(rom_db_text, geometry=DEFAULT_GEOMETRY):
+    rom_db = [[] for bit in range(geometry.width)]
+    problems = []
+    for (number, line) in enumerate(rom_db_text.splitlines(), 1):
+        items = line.split()
+        if len(items) == 0:
+            continue
+        if len(items) < 4 or items[0] != 'KEYROM':
+            problems.append("line {}: expected 'KEYROM <data bit> <stripe> <slice> ...', not '{}'".format(number, line.strip()))
+            continue
+        try:
+            bit = int(items[1])
+        except ValueError:
+            problems.append("line {}: data bit '{}' is not a number".format(number, items[1]))
+            continue
+        if not 0 <= bit < geometry.width:
+            problems.append("line {}: data bit {} is outside of the {} bit wide key ROM".format(number, bit, geometry.width))
+            continue
+        try:
+            lut = geometry.stripe_index(items[2])
+        except ValueError as e:
+            problems.append("line {}: {}".format(number, e))
+            continue
+        if SLICE_NAME.match(items[3]) is None:
+            problems.append("line {}: '{}' is not a SLICE_X<n>Y<n> name".format(number, items[3]))
+            continue
+        bel = items[5] if len(items) > 5 else items[2]
+        rom_db[bit] += [{'lut': lut, 'bel': bel + 'LUT', 'slice': items[3]}]
+    if len(problems) != 0:
+        found = []
+        _report(found, problems)
+        raise RomDbError(found, "rom.db is malformed")
+    return rom_db
+
+def read_rom_db(romdb_file, geometry=DEFAULT_GEOMETRY):
+    with open(romdb_file, "r") as f:
+        return parse_rom_db(f.read(), geometry)
+
+# keybytes is the contents of a key ROM file: big-endian 32-bit words
+def parse_keyrom(keybytes):
     keyrom = []
+    index = 0
+    while index < len(keybytes):
+        word = int().from_bytes(keybytes[index:index+4], byteorder='big', signed=False)
+        index = index + 4
+        keyrom += [word]
+    return keyrom
+
+# falls back to a random key if the key file can't be read
+def read_keyrom(key_file, depth=ROM_DEPTH):
     try:
-        with open(args.keys, "rb") as f:
-            keybytes = f.read()
-            index = 0
-            while index < len(keybytes):
-                word = int().from_bytes(keybytes[index:index+4], byteorder='big', signed=False)
-                index = index + 4
-                keyrom += [word]
-        if len(keyrom) != 256:
+        with open(key_file, "rb") as f:
+            keyrom = parse_keyrom(f.read())
+        if len(keyrom) != depth:
             print("warning: key.bin file size is wrong, are you using the right file?")
     except:
-        for i in range(256):
+        keyrom = []
+        for i in range(depth):
             keyrom += [int().from_bytes(os.urandom(4), byteorder='big', signed=False)]
+    return keyrom
+
+# a plan is valid for one rom.db and ROM geometry against one set of databases
+def plan_key(romdb_file, tilegrid_file, part_file, segbits_path, geometry=DEFAULT_GEOMETRY):
+    hasher = hashlib.sha256()
+    for digest in hash_files(romdb_file, tilegrid_file, part_file, *segbits_files(segbits_path)):
+        hasher.update(digest)
+    hasher.update(struct.pack('<III', *geometry))
+    return hasher.digest()
+
+# the segbits of a LUT: a 64-entry list of (function index, bit offset), one per INIT bit;
+# raises KeyError if the databases have none for it
+def lut_segbits(part, slice, bel):
+    (tile_type, frameaddress, frameindex) = part.slices[slice]
+    xy = re.split('[XY]', slice)
+    x = int(xy[1])
+    if (x % 2) == 0:
+        return part.segbits.lut(tile_type, 'X0', bel)
+    else:
+        return part.segbits.lut(tile_type, 'X1', bel)
+
+# the (frame address, word offset, bit) location of each of the first count INIT bits of a LUT
+def lut_init_bits(part, slice, bel, count=LUT_SIZE):
+    # part.slices is a lookup for SLICE locations to base frame addresses and offsets
+    # part.segbits is a lookup of a slice/lut position to a function index + bit offset
+    (tile_type, frameaddress, frameindex) = part.slices[slice]
+    segloc = lut_segbits(part, slice, bel)
+    # I now segloc, which is a 64-entry list, one corresponding to each bit of the ROM INIT LUT
+    # each entry is a (function index, bit) pair
+    locations = []
+    for init_bit in range(count):
+        thisbit_frameindex = frameindex
+        (function_offset, bit_offset) = segloc[init_bit]
+        # now convert from 64-bit "function" bit position as documented in segbits to a 32-bit "stream" bit position
+        # it's a big-endian mapping
+        if bit_offset < 32:
+            thisbit_frameindex += 1
+        else:
+            bit_offset -= 32
+        locations.append((frameaddress + function_offset, thisbit_frameindex, bit_offset))
+    return locations
 
-    #-----------  DERIVE THE PATCHING LIST ------------
-    # at this point, we want to derive a list of addresses to patch in the bitstream,
-    # each list entry is a 32-entry dictionary, and each entry corresponds to an (address, bit) position in rom.bin
-    patchdata = {}
-    for keyrom_data_bit in range(32):
-        item = rom_db[keyrom_data_bit]
-        for lut in range(4):
-            slices = item[lut]
-            slice = slices['slice']
-            bel = slices['bel']
-            base_record = slice_db[slice]
-            frameaddress = int(base_record['baseaddr'],16)
-            frameindex = int(base_record['offset'])
-            xy = re.split('[XY]', slice)
-            x = int(xy[1])
-            if (x % 2) == 0:
-                segloc = segbits_db['X0'][bel]
+"""
+rom.db validation.
+
+A bad rom.db does not fail by itself: it patches the wrong bitstream bits, and the device
+silently ends up with a corrupted key. derive_plan() therefore checks, before building a plan:
+
+  - every LUT is on a slice that exists in tilegrid.json, on a LUT BEL, and has segbits
+  - every data bit maps each of its stripes exactly once, and no LUT is used twice
+  - no two key bits land on the same bitstream bit, with a bitset over the framestream bits
+  - every key bit lands on exactly one bitstream bit, and every patched word is fully covered
+
+and raises a RomDbError listing the problems found. parse_rom_db() raises one as well for
+lines it can't read (too short, a data bit outside the ROM width, an unknown stripe), so
+every bad rom.db ends in the same clean error. The checks are linear in the number of key
+bits, and cheap enough to always leave on.
+"""
+class RomDbError(ValueError):
+    def __init__(self, problems, summary="rom.db does not match the databases"):
+        ValueError.__init__(self, summary + ":\n  " + "\n  ".join(problems))
+        self.problems = problems
+
+MAX_PROBLEMS = 16 # problems reported per check, so a badly broken rom.db gives a readable error
+
+def _report(problems, found):
+    problems += found[:MAX_PROBLEMS]
+    if len(found) > MAX_PROBLEMS:
+        problems.append("... and {} more".format(len(found) - MAX_PROBLEMS))
+
+# the placement checks, which only need rom.db and the slice database; returns a list of problems
+def check_rom_db(part, rom_db, geometry=DEFAULT_GEOMETRY):
+    problems = []
+    luts = {}
+    for bit in range(geometry.width):
+        stripes = sorted(lut['lut'] for lut in rom_db[bit])
+        if stripes != list(range(geometry.luts)):
+            problems.append("data bit {} maps stripes {}, expected each of {} exactly once".format(
+                bit, ''.join(geometry.stripe_name(lut) for lut in stripes) or 'none',
+                ''.join(geometry.stripe_name(lut) for lut in range(geometry.luts))))
+        for lut in rom_db[bit]:
+            cell = 'KEYROM{}{}'.format(bit, geometry.stripe_name(lut['lut']))
+            if lut['slice'] not in part.slices:
+                problems.append("{}: slice {} is not in tilegrid.json".format(cell, lut['slice']))
+            elif lut['bel'] not in SEGBITS_BELS:
+                problems.append("{}: {} is not a LUT BEL".format(cell, lut['bel']))
             else:
-                segloc = segbits_db['X1'][bel]
-            # I now segloc, which is a 64-entry list, one corresponding to each bit of the ROM INIT LUT
-            # each entry is a (function index, bit) pair
-            if bel == 'ALUT':
-                keyrom_addr_offset = 0
-            elif bel == 'BLUT':
-                keyrom_addr_offset = 64
-            elif bel == 'CLUT':
-                keyrom_addr_offset = 128
+                try:
+                    lut_segbits(part, lut['slice'], lut['bel'])
+                except KeyError as e:
+                    problems.append("{}: {}".format(cell, e.args[0]))
+            location = (lut['slice'], lut['bel'])
+            if location in luts:
+                problems.append("{}: {} {} is already used by {}".format(cell, lut['slice'], lut['bel'], luts[location]))
             else:
-                keyrom_addr_offset = 192
-            for keyrom_addr_lsb in range(64):
-                thisbit_frameaddress = frameaddress
-                thisbit_frameindex = frameindex
-                keyrom_addr = keyrom_addr_offset + keyrom_addr_lsb
-
-                entry = segloc[keyrom_addr_lsb]
-
-                function_offset = int(entry[0])
-                bit_offset = int(entry[1])
-                # now convert from 64-bit "function" bit position as documented in segbits to a 32-bit "stream" bit position
-                # it's a big-endian mapping
-                if bit_offset < 32:
-                    thisbit_frameindex += 1
-                else:
-                    bit_offset -= 32
+                luts[location] = cell
+    reported = []
+    _report(reported, problems)
+    return reported
+
+# the bit-level checks; bits is a list of (frame address, word offset, bit, key bit index)
+def check_plan_bits(bits, framestream, geometry=DEFAULT_GEOMETRY):
+    problems = []
+    frame_words = xc7bitstream.FRAME_WORDS
+    out_of_frame = ["frame 0x{:08x} word {} is outside of the frame".format(frameaddress, word)
+                    for (frameaddress, word, bit, src) in bits if word >= frame_words]
+    _report(problems, out_of_frame)
+    if len(out_of_frame) != 0:
+        return problems
+
+    # collisions: one bit per framestream bit
+    limit = (max(framestream.values()) + 1) * frame_words * 32
+    seen = bytearray((limit + 7) >> 3)
+    collisions = []
+    for (frameaddress, word, bit, src) in bits:
+        index = (framestream[frameaddress] * frame_words + word) * 32 + bit
+        if seen[index >> 3] & (1 << (index & 7)):
+            collisions.append("frame 0x{:08x} word {} bit {} is mapped more than once, again by key address {} bit {}".format(
+                frameaddress, word, bit, *divmod(src, geometry.width)))
+        seen[index >> 3] |= 1 << (index & 7)
+    _report(problems, collisions)
+
+    # coverage: every key bit exactly once
+    coverage = bytearray(geometry.depth * geometry.width)
+    for (frameaddress, word, bit, src) in bits:
+        if coverage[src] < 2:
+            coverage[src] += 1
+    uncovered = ["key address {} bit {} lands {}".format(*divmod(src, geometry.width), "nowhere" if count == 0 else "more than once")
+                 for (src, count) in enumerate(coverage) if count != 1]
+    _report(problems, uncovered)
+    return problems
+
+# the bits to patch for one data bit of the ROM: a list of (frame address, word offset, bit, flat
+# key bit index) tuples, where the flat key bit index is address * width + data bit
+def data_bit_bits(part, keyrom_data_bit, item, geometry=DEFAULT_GEOMETRY):
+    bits = []
+    for slices in item:
+        keyrom_addr_offset = slices['lut'] * geometry.lut_size
+        init_bits = lut_init_bits(part, slices['slice'], slices['bel'], geometry.lut_size)
+        for (keyrom_addr_lsb, (frameaddress, frameindex, bit_offset)) in enumerate(init_bits):
+            keyrom_addr = keyrom_addr_offset + keyrom_addr_lsb
+            bits.append((frameaddress, frameindex, bit_offset, keyrom_addr * geometry.width + keyrom_data_bit))
+    return bits
+
+# process pool workers each load the part database once, through the (already fresh) cache
+_derive_part = None
+
+def _init_derive_worker(sources):
+    global _derive_part
+    _derive_part = load_part_database(*sources)
+
+def _derive_data_bit(job):
+    (keyrom_data_bit, item, geometry) = job
+    return data_bit_bits(_derive_part, keyrom_data_bit, item, geometry)
 
-                thisbit_frameaddress += function_offset
+"""
+Derive the patch plan for a rom.db. With workers > 1, the per data bit work is spread over a
+process pool; sources is then the (tilegrid, part, segbits, cache) file tuple that part was
+loaded from, for the workers to load it again. The results are merged in data bit order, so
+the plan is identical to the serial one.
+"""
+def derive_plan(part, rom_db, geometry=DEFAULT_GEOMETRY, workers=1, sources=None):
+    problems = check_rom_db(part, rom_db, geometry)
+    if len(problems) != 0:
+        raise RomDbError(problems)
+
+    # at this point, we want to derive a list of bits to patch in the bitstream, data bit by data bit
+    jobs = [(keyrom_data_bit, rom_db[keyrom_data_bit], geometry) for keyrom_data_bit in range(geometry.width)]
+    if workers > 1 and sources is not None:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_derive_worker, initargs=(sources,)) as pool:
+            chunksize = max(1, len(jobs) // (workers * 4))
+            results = list(pool.map(_derive_data_bit, jobs, chunksize=chunksize))
+    else:
+        results = [data_bit_bits(part, *job) for job in jobs]
+    bits = [bit for result in results for bit in result]
+
+    # translate the frame addresses to framestream positions, and check the bits before using them
+    frame_addresses = sorted(set(bit[0] for bit in bits))
+    framestream = dict(zip(frame_addresses, part.framestream.translate_many(frame_addresses)))
+    problems = check_plan_bits(bits, framestream, geometry)
+    if len(problems) != 0:
+        raise RomDbError(problems)
+
+    # group the bits into words: each entry maps a (frame address, word offset) location to a
+    # 32-entry list, with the key bit that feeds each bit of the word
+    patchdata = {}
+    for (frameaddress, frameindex, bit_offset, src) in bits:
+        location = (frameaddress, frameindex)
+        if location in patchdata:
+            wordbits = patchdata[location]
+        else:
+            wordbits = [None]*32
+            patchdata[location] = wordbits
+        # store the keyrom address to bit mapping for a given stream address offset
+        wordbits[bit_offset] = src
+
+    # sort the patched words and pack the plan into arrays
+    locations = sorted(patchdata.keys())
+    positions = array.array('I')
+    offsets = array.array('I')
+    sources = array.array('I')
+    for location in locations:
+        wordbits = patchdata[location]
+        if None in wordbits:
+            raise RomDbError(["frame 0x{:08x} word {} is only partly covered by the key ROM".format(*location)])
+        positions.append(framestream[location[0]])
+        offsets.append(location[1])
+        sources.extend(wordbits)
+    return PatchPlan(geometry.width, geometry.depth, positions, offsets, sources)
+
+class PatchPlan:
+    def __init__(self, width, depth, positions, words, sources):
+        self.width = width
+        self.depth = depth
+        self.positions = positions
+        self.words = words
+        self.sources = sources
+        self._gather = None
+
+    def __len__(self):
+        return len(self.words)
+
+    # the plan grouped by frame: yields (framestream position, [(word offset, sources), ...])
+    def iter_frames(self):
+        start = 0
+        while start < len(self.positions):
+            position = self.positions[start]
+            end = start + 1
+            while end < len(self.positions) and self.positions[end] == position:
+                end += 1
+            yield (position, [(self.words[n], self.sources[n * 32:(n + 1) * 32]) for n in range(start, end)])
+            start = end
+
+    # framestream positions of the patched frames, in plan order
+    def frame_positions(self):
+        return [position for (n, position) in enumerate(self.positions) if n == 0 or self.positions[n - 1] != position]
+
+    def save(self, plan_file, key):
+        out = bytearray(PLAN_HEADER.pack(PLAN_MAGIC, PLAN_VERSION, self.width, self.depth, key, len(self)))
+        for table in (self.positions, self.words, self.sources):
+            out += table.tobytes() if sys.byteorder == 'little' else byteswapped(table).tobytes()
+        plan_dir = os.path.dirname(plan_file)
+        if plan_dir != '':
+            os.makedirs(plan_dir, exist_ok=True)
+        with open(plan_file + '.tmp', "wb") as f:
+            f.write(out)
+        os.replace(plan_file + '.tmp', plan_file)
+
+    # returns None if the plan is missing or was derived from different inputs
+    @classmethod
+    def load(cls, plan_file, key):
+        try:
+            with open(plan_file, "rb") as f:
+                buf = f.read()
+        except OSError:
+            return None
+        if len(buf) < PLAN_HEADER.size:
+            return None
+        (magic, version, width, depth, plan_hash, count) = PLAN_HEADER.unpack_from(buf, 0)
+        if magic != PLAN_MAGIC or version != PLAN_VERSION or plan_hash != key:
+            return None
+        if len(buf) != PLAN_HEADER.size + count * 34 * 4:
+            return None
+        tables = []
+        offset = PLAN_HEADER.size
+        for length in (count, count, count * 32):
+            table = array.array('I')
+            table.frombytes(buf[offset:offset + length * 4])
+            if sys.byteorder != 'little':
+                table.byteswap()
+            tables.append(table)
+            offset += length * 4
+        return cls(width, depth, *tables)
+
+    # the (N_words x 32) gather index array, in plan order
+    def gather_table(self):
+        if self._gather is None:
+            self._gather = np.frombuffer(self.sources, dtype=np.uint32).astype(np.intp).reshape(-1, 32)
+        return self._gather
+
+    # group per-word values, in plan order, into (framestream position, [(word offset, value), ...])
+    def group(self, values):
+        patches = []
+        for (n, value) in enumerate(values):
+            position = self.positions[n]
+            if len(patches) == 0 or patches[-1][0] != position:
+                patches.append((position, []))
+            patches[-1][1].append((self.words[n], value))
+        return patches
+
+    # returns a list of (framestream position, [(word offset, value), ...]), one per plan frame
+    def apply(self, keyrom):
+        if np is not None:
+            # unpack the key into a (depth x width) bit matrix, flattened, and gather every patch word at once
+            shifts = np.arange(self.width, dtype=np.uint64)
+            keybits = ((np.array(keyrom, dtype=np.uint64)[:, None] >> shifts) & 1).reshape(-1)
+            values = (keybits[self.gather_table()] << np.arange(32, dtype=np.uint64)).sum(axis=1).tolist()
+        else:
+            # unpack the key into a string of '0'/'1', indexed by flat key bit index; words are
+            # masked to the ROM width, like the shifts above, so each is exactly width bits
+            mask = (1 << self.width) - 1
+            keybits = ''.join(format(word & mask, '0{}b'.format(self.width))[::-1] for word in keyrom)
+            sources = self.sources
+            values = [int(''.join([keybits[src] for src in reversed(sources[n * 32:(n + 1) * 32])]), 2)
+                      for n in range(len(self))]
+        return self.group(values)
+
+    # the inverse of apply(): scatter patch word values, in plan order, back into a key ROM
+    def extract(self, values):
+        if np is not None:
+            keybits = np.zeros(self.depth * self.width, dtype=np.uint64)
+            wordbits = (np.array(values, dtype=np.uint64)[:, None] >> np.arange(32, dtype=np.uint64)) & 1
+            keybits[self.gather_table().reshape(-1)] = wordbits.reshape(-1)
+            keyrom = (keybits.reshape(self.depth, self.width) << np.arange(self.width, dtype=np.uint64)).sum(axis=1)
+            return keyrom.tolist()
+        keyrom = [0] * self.depth
+        for (index, src) in enumerate(self.sources):
+            if (values[index // 32] >> (index % 32)) & 1:
+                keyrom[src // self.width] |= 1 << (src % self.width)
+        return keyrom
+
+def byteswapped(table):
+    table = array.array(table.typecode, table)
+    table.byteswap()
+    return table
 
-                if thisbit_frameaddress in patchdata:
-                    frame = patchdata[thisbit_frameaddress]
-                else:
-                    frame = [None]*101
+"""
+Load the patch plan for a rom.db: from a saved plan file if it is still valid, otherwise by
+deriving it from the databases (through the database cache), on workers processes. A derived
+plan is saved back to plan_file, if one is given.
+"""
+def load_plan(romdb_file=DEFAULT_ROMDB, tilegrid_file=DEFAULT_TILEGRID, part_file=DEFAULT_PART,
+              segbits_file=DEFAULT_SEGBITS, cache_file=DEFAULT_CACHE, plan_file=None, geometry=DEFAULT_GEOMETRY,
+              workers=1):
+    geometry.validate()
+    if plan_file is not None:
+        plan_hash = plan_key(romdb_file, tilegrid_file, part_file, segbits_file, geometry)
+        plan = PatchPlan.load(plan_file, plan_hash)
+        if plan is not None:
+            return plan
+
+    part = load_part_database(tilegrid_file, part_file, segbits_file, cache_file)
+    plan = derive_plan(part, read_rom_db(romdb_file, geometry), geometry, workers,
+                       (tilegrid_file, part_file, segbits_file, cache_file))
+    if plan_file is not None:
+        plan.save(plan_file, plan_hash)
+    return plan
+
+# write a patch list in the given format, see patchfile.py; binary needs a binary file
+def write_patches(f, patches, patch_format='text'):
+    if patch_format == 'binary':
+        patchfile.write_binary(f, patches)
+    else:
+        patchfile.write_text(f, patches)
 
-                if frame[thisbit_frameindex] == None:
-                    frame[thisbit_frameindex] = {}
+"""
+Direct bitstream patching.
 
-                # store the keyrom address to bit mapping for a given stream address offset
-                if bit_offset in frame[thisbit_frameindex]:
-                    print("warning: overwriting a patch bit, should not happen!")
-                frame[thisbit_frameindex][bit_offset] = [keyrom_addr, keyrom_data_bit]
+Instead of emitting a patch list for another tool to parse and apply, write the patch words
+straight into a memory-mapped copy of the bitstream, and fix up the CRC checks that follow
+the frame data. This only works on unencrypted bitstreams.
+"""
+def patch_bitstream(bitstream_file, output_file, patches):
+    if output_file is not None and output_file != bitstream_file:
+        shutil.copyfile(bitstream_file, output_file)
+    else:
+        output_file = bitstream_file
+    with open(output_file, "r+b") as f:
+        with mmap.mmap(f.fileno(), 0) as bits:
+            layout = xc7bitstream.BitstreamLayout(bits)
+            xc7bitstream.patch_frames(bits, layout, patches)
+            bits.flush()
 
-                patchdata[thisbit_frameaddress] = frame
+"""
+Key ROM extraction.
 
-    #-----------  SORT PATCH LIST AND TRANSLATE ADDRESS TO FRAMESTREAM POSITION ------------
-    patchdata_sorted = []
-    for key in sorted(patchdata.keys()):
-        patchdata_sorted += [[address_to_framestream(part_db, key), patchdata[key]]]
+The reverse of patching: read the patched words back out of an (unencrypted or decrypted)
+bitstream through the same plan, and reassemble the key ROM, so that a sealed image can be
+checked against the keystore.bin it was sealed with.
+"""
+def extract_keyrom(bitstream_file, plan):
+    with open(bitstream_file, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as bits:
+            layout = xc7bitstream.BitstreamLayout(bits)
+            if layout.encrypted:
+                raise ValueError("bitstream is encrypted, decrypt it before extracting the key ROM")
+            locations = [(position, [word for (word, sources) in words]) for (position, words) in plan.iter_frames()]
+            values = xc7bitstream.read_frames(bits, layout, locations)
+    return plan.extract(values)
 
-    #-----------  OUTPUT THE PATCHING LIST ------------
-    if args.code == False:
-        for frame_rec in patchdata_sorted:
-            print("0x{:08x}".format(frame_rec[0]), end='')
-            frame = frame_rec[1]
-            for word in range(101):
-                if frame[word] == None:
-                    print(',none', end='')
-                else:
-                    wordvalue = 0
-                    wordbits = frame[word]
-                    for bit in range(32):
-                        coord = wordbits[bit]
-                        bitvalue = (keyrom[coord[0]] & (1 << coord[1]))
-                        if bitvalue != 0:
-                            wordvalue |= (1 << bit)
-                    print(',0x{:08x}'.format(wordvalue), end='')
-            print("")
-    else:
-        print("""#![no_std]
+"""
+Rust code generation for fw/rom-inject.
 
-// Plug in the allocator crate
-#[macro_use]
-extern crate alloc;
-extern crate alloc_riscv;
+The patch plan is emitted as static, sorted tables, so that patch_frame() allocates nothing
+and finds a framestream word with two binary searches:
+
+  FRAMES       framestream positions that carry key bits, sorted
+  FRAME_WORDS  WORDS/BITS index of the first patched word of each frame, plus an end marker
+  WORDS        offset of each patched word within its frame, sorted within each frame
+  BITS         32 packed (adr, bit) pairs per patched word, LSB of the patch word first
+
+The ROM is passed in as a [u32; ROM_DEPTH] array, with ROM_DEPTH following the plan's geometry.
+
+Besides patch_frame(), the generated code provides PatchCursor, which walks the tables in
+framestream order so that sequential patching costs O(1) per framestream word.
+
+The source is generated as a stream of lines by rust_lines(), and write_rust() joins them
+into large writes, so the cost is linear in the size of lib.rs and nothing but the current
+batch of lines is held in memory.
+"""
+# the generated code, as a stream of lines
+def rust_lines(plan, keyrom, patches=None):
+    if patches is None:
+        patches = plan.apply(keyrom)
+    frames = plan.frame_positions()
+    frame_words = [n for n in range(len(plan)) if n == 0 or plan.positions[n - 1] != plan.positions[n]] + [len(plan)]
+    # BITS entries are (adr, bit) pairs, so the element type has to hold the largest address
+    if plan.depth <= 256:
+        bits_type = 'u8'
+    else:
+        bits_type = 'u16'
 
-use alloc::vec::Vec;
+    yield """#![no_std]
 
+// this file is auto-generated by key2bits.py
+//
+// the patch locations are stored as static tables, sorted by frame and then by offset:
+// FRAMES lists the frames to patch, FRAME_WORDS[i]..FRAME_WORDS[i+1] is the range of
+// WORDS (offsets within the frame) and BITS (the key ROM (adr, bit) pair feeding each
+// bit of the patched word) belonging to FRAMES[i].
+"""
+    yield "pub const ROM_DEPTH: usize = {};\n".format(plan.depth)
+    yield "static FRAMES: [u32; {}] = [\n".format(len(frames))
+    for i in range(0, len(frames), 8):
+        yield "    " + " ".join("0x{:x},".format(position) for position in frames[i:i+8]) + "\n"
+    yield "];\n"
+    yield "static FRAME_WORDS: [u16; {}] = [\n".format(len(frame_words))
+    for i in range(0, len(frame_words), 16):
+        yield "    " + " ".join("{},".format(index) for index in frame_words[i:i+16]) + "\n"
+    yield "];\n"
+    yield "static WORDS: [u8; {}] = [\n".format(len(plan))
+    for i in range(0, len(plan), 16):
+        yield "    " + " ".join("{},".format(word) for word in plan.words[i:i+16]) + "\n"
+    yield "];\n"
+    yield "static BITS: [[[{}; 2]; 32]; {}] = [\n".format(bits_type, len(plan))
+    # BITS is most of the output, so each row of 8 pairs is a single format call
+    bits_row = "        " + " ".join(["[{:3}, {:2}],"] * 8) + "\n"
+    width = plan.width
+    for n in range(len(plan)):
+        yield "    [\n"
+        for i in range(n * 32, (n + 1) * 32, 8):
+            yield bits_row.format(*[field for src in plan.sources[i:i+8] for field in (src // width, src % width)])
+        yield "    ],\n"
+    yield "];\n"
+    yield """
 /// patch a frame at a given relative positition and offset in the framestream
 /// to insert a key ROM.
 ///
-/// this file is auto-generated by key2bits.py
-/// 
 /// frame is the frame number in the framestream
 /// offset is the offset in the frame, from 0-100 (101 words)
 /// note that each primitive in a bitstream is a u32
-/// 
-/// we are using a Vec for the frame data, even though frames have a well-known length
-/// of up to 101 elements. The reason is that typically the number of items to patch
-/// in a frame is usually much less than the 101 elements, and so it is wasteful to code
-/// for the unused elements statically. That being said, this results in the initialization
-/// of the function taking quite a lot of code space, as every element is turned into a
-/// load/store pair as the Vecs are dynamically allocated. One possible optimization
-/// is to determine the maximum length of any PatchFrame array and create a coding for
-/// words that should be skipped in case the frames are not homogenous in patch location
-/// vs length, and then turn these into slices or a [T; N] notation const. However,
-/// we'll stick with this for now as there are more important thing to do than optimize
-/// this code.
+///
+/// the lookup is two binary searches over static tables, and allocates nothing.
 ///
 /// returns None if the position should not be patched
 /// returns a tuple of the value and its inverse; this is done to reduce the timing
 /// sidechannel. The inverse value needs to be consumed to prevent the compiler
 /// from optimizing out that path.
-#[derive(Copy,Clone)]
-pub struct PatchBit {
-    adr: u8,
-    bit: u8,
+pub fn patch_frame(frame: u32, offset: u32, rom: [u32; ROM_DEPTH]) -> (Option<u32>, Option<u32>) {
+    let f = match FRAMES.binary_search(&frame) {
+        Ok(f) => f,
+        Err(_) => return (None, None),
+    };
+    if offset > u8::MAX as u32 {
+        return (None, None)
+    }
+    let start = FRAME_WORDS[f] as usize;
+    let end = FRAME_WORDS[f + 1] as usize;
+    let w = match WORDS[start..end].binary_search(&(offset as u8)) {
+        Ok(w) => start + w,
+        Err(_) => return (None, None),
+    };
+
+    let (data, data_inv) = gather(w, &rom);
+    (Some(data), Some(data_inv))
 }
-pub struct PatchWord {
-    offset: u8,
-    bits: [PatchBit; 32],
+
+// gather the value of patched word w from the key ROM, along with its inverse
+fn gather(w: usize, rom: &[u32; ROM_DEPTH]) -> (u32, u32) {
+    let mut data: u32 = 0;
+    let mut data_inv: u32 = 0;
+    for bit in 0..32 {
+        let [adr, b] = BITS[w][bit];
+        let romval: u32 = rom[adr as usize] & (1 << b);
+        if romval != 0 {
+            data |= 1 << bit;
+        } else {
+            data_inv |= 1 << bit;
+        }
+    }
+    (data, data_inv)
 }
-pub struct PatchFrame {
-    frame: u32,
-    words: Vec<PatchWord>,
+
+/// a patch to apply: the word at offset in frame is replaced by data; data_inv is its inverse
+#[derive(Copy, Clone, Debug, PartialEq, Eq)]
+pub struct Patch {
+    pub frame: u32,
+    pub offset: u32,
+    pub data: u32,
+    pub data_inv: u32,
 }
-pub fn patch_frame(frame: u32, offset: u32, rom: [u32; 256]) -> (Option<u32>, Option<u32>) {
-""")
-
-        for frame_rec in patchdata_sorted:
-            # print("Patch on relative frame 0x{:08x}: ".format(frame_rec[0]), end='')
-            frame = frame_rec[1]
-            patchvec = ""
-            for word in range(101):
-                if frame[word] == None:
-                    continue
-                else:
-                    wordvalue = 0
-                    wordbits = frame[word]
-                    thebits = ""
-                    for bit in range(32):
-                        coord = wordbits[bit]
-                        thebits += "                         PatchBit { adr: " + "{:3}".format(coord[0]) + ", bit: " + "{:2}".format(coord[1]) + " }, \n"
-                        patchbit =  "{}".format(thebits)
-                    patchword = "\n           PatchWord { offset:" + "{}".format(word) +",\n                       bits:\n                      [\n" + "{}".format(patchbit) + "                     ] }, \n"
-                    patchvec += patchword
-            print("    let frame_{:x}".format(frame_rec[0]) + ": PatchFrame = PatchFrame {\n       frame: 0x" + "{:x}".format(frame_rec[0]) + ", \n       words: vec![" + "{}".format(patchvec) + "] };")
-
-        print("""
-    let table = vec![""")
-        for frame_rec in patchdata_sorted:
-            print("        frame_{:x},".format(frame_rec[0]))
-        print(    """];
-
-    for frames in table.iter() {
-        if frames.frame == frame {
-            for word in frames.words.iter() {
-                if word.offset == offset as u8 {
-                    let mut data: u32 = 0;
-                    let mut data_inv: u32 = 0;
-                    for bit in 0..32 {
-                        let patch: PatchBit = word.bits[bit];
-                        let romval: u32 = rom[patch.adr as usize] & (1 << patch.bit);
-                        if romval != 0 {
-                            data |= 1 << bit;
-                        } else {
-                            data_inv |= 1 << bit;
-                        }
-                    }
-                    return (Some(data), Some(data_inv))
-                }
+
+/// a cursor over the patch locations in framestream order, for patching a framestream
+/// that is processed sequentially.
+///
+/// as an Iterator, it yields every Patch in order. Alternatively, patch() can be called
+/// for every word of the framestream as it streams by; it behaves like patch_frame(),
+/// except that it only ever compares against the next patch location, so each call is
+/// O(1) instead of a table search. Positions must be presented in increasing order.
+pub struct PatchCursor<'a> {
+    rom: &'a [u32; ROM_DEPTH],
+    frame: usize,
+    word: usize,
+}
+
+impl<'a> PatchCursor<'a> {
+    pub fn new(rom: &'a [u32; ROM_DEPTH]) -> Self {
+        PatchCursor { rom, frame: 0, word: 0 }
+    }
+
+    /// the (frame, offset) of the next patch, or None if all patches have been applied
+    pub fn next_position(&self) -> Option<(u32, u32)> {
+        if self.word < WORDS.len() {
+            Some((FRAMES[self.frame], WORDS[self.word] as u32))
+        } else {
+            None
+        }
+    }
+
+    fn advance(&mut self) {
+        self.word += 1;
+        while self.frame < FRAMES.len() && self.word >= FRAME_WORDS[self.frame + 1] as usize {
+            self.frame += 1;
+        }
+    }
+
+    pub fn patch(&mut self, frame: u32, offset: u32) -> (Option<u32>, Option<u32>) {
+        // skip over patch locations that the caller has already streamed past
+        while let Some(next) = self.next_position() {
+            if next >= (frame, offset) {
+                break;
             }
+            self.advance();
         }
+        if self.next_position() != Some((frame, offset)) {
+            return (None, None)
+        }
+        let (data, data_inv) = gather(self.word, self.rom);
+        self.advance();
+        (Some(data), Some(data_inv))
     }
+}
+
+impl<'a> Iterator for PatchCursor<'a> {
+    type Item = Patch;
 
-    return (None, None)
+    fn next(&mut self) -> Option<Patch> {
+        let (frame, offset) = self.next_position()?;
+        let (data, data_inv) = gather(self.word, self.rom);
+        self.advance();
+        Some(Patch { frame, offset, data, data_inv })
+    }
 }
 
 #[cfg(test)]
 mod tests {
+    use crate::*;
+
+    const ROM: [u32; ROM_DEPTH] = [\n
+"""
+    for word in keyrom:
+        yield '               0x{:08x},\n'.format(word)
+    yield """
+                 ];
+
+    #[test]
+    fn check_cursor() {
+        // stream every word of every patched frame past the cursor, plus the unpatched frame 0
+        let mut cursor = PatchCursor::new(&ROM);
+        for offset in 0..101 {
+            assert_eq!(cursor.patch(0x0, offset), (None, None));
+        }
+        for frame in FRAMES.iter() {
+            for offset in 0..101 {
+                assert_eq!(cursor.patch(*frame, offset), patch_frame(*frame, offset, ROM));
+            }
+        }
+        assert_eq!(cursor.next_position(), None);
+
+        assert_eq!(PatchCursor::new(&ROM).count(), WORDS.len());
+        for patch in PatchCursor::new(&ROM) {
+            assert_eq!(patch.data, !patch.data_inv);
+            assert_eq!(patch_frame(patch.frame, patch.offset, ROM), (Some(patch.data), Some(patch.data_inv)));
+        }
+    }
 
     #[test]
     fn check_frames() {
 
-        const ROM: [u32; 256] = [\n""")
-        for word in keyrom:
-            print('               0x{:08x},'.format(word))
-        print("""
-                 ];""")
-        for frame_rec in patchdata_sorted:
-            frame = frame_rec[1]
-            for word in range(101):
-                if frame[word] == None:
-                    break
-                else:
-                    wordvalue = 0
-                    wordbits = frame[word]
-                    for bit in range(32):
-                        coord = wordbits[bit]
-                        bitvalue = (keyrom[coord[0]] & (1 << coord[1]))
-                        if bitvalue != 0:
-                            wordvalue |= (1 << bit)
-                    print('        assert_eq!(crate::patch_frame({}'.format(frame_rec[0]) + ', ' + '{}'.format(word) + ', ROM), (Some(' + '0x{:08x}'.format(wordvalue) + '), Some(!0x{:08x}'.format(wordvalue) + ')));')
-
-        print('        // also test the null case, frame 0 should typically have no mappings.')
-        print('        assert_eq!(crate::patch_frame(0x0, 0, ROM), (None, None) );')
-        print("""
+"""
+    for patch_rec in patches:
+        for (word, wordvalue) in patch_rec[1]:
+            yield '        assert_eq!(crate::patch_frame({}, {}, ROM), (Some(0x{:08x}), Some(!0x{:08x})));\n'.format(patch_rec[0], word, wordvalue, wordvalue)
+
+    yield '        // also test the null case, frame 0 should typically have no mappings.\n'
+    yield '        assert_eq!(crate::patch_frame(0x0, 0, ROM), (None, None) );\n'
+    yield """
     }
 }
-        """)
+        
+"""
+
+RUST_WRITE_LINES = 1024 # lines joined per write
+
+# write the generated code to a text file (or io.StringIO), in large joined writes
+def write_rust(f, plan, keyrom, patches=None):
+    chunk = []
+    for line in rust_lines(plan, keyrom, patches):
+        chunk.append(line)
+        if len(chunk) == RUST_WRITE_LINES:
+            f.write(''.join(chunk))
+            chunk.clear()
+    f.write(''.join(chunk))
+
+def rust_code(plan, keyrom):
+    out = io.StringIO()
+    write_rust(out, plan, keyrom)
+    return out.getvalue()
+
+"""
+Output files.
+
+Every output is rendered from the patch plan and the key ROM; rendering is cheap next to
+deriving the plan, so only the plan, which does not depend on the key, is cached (see
+load_plan()). Patch lists and lib.rs both encode the key ROM, so nothing derived from a key
+is stored anywhere but the requested output file. build_output() writes that file only if
+its contents actually change, which keeps its mtime -- and anything downstream that depends
+on it, like the rom-inject crate -- untouched.
+"""
+OUTPUT_KINDS = ['rust', 'text', 'binary']
+
+# write data (bytes) to path, unless path already holds exactly that; returns True if written
+def write_if_changed(path, data):
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+    with open(path + '.tmp', "wb") as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+# kind is one of OUTPUT_KINDS: rust code, or a text or binary patch list; returns bytes
+def render_output(kind, plan, keyrom):
+    if kind == 'rust':
+        return rust_code(plan, keyrom).encode('utf-8')
+    patches = plan.apply(keyrom)
+    if kind == 'binary':
+        out = io.BytesIO()
+        write_patches(out, patches, 'binary')
+        return out.getvalue()
+    out = io.StringIO()
+    write_patches(out, patches)
+    return out.getvalue().encode('utf-8')
+
+"""
+Generate an output for a key ROM file into output_file, from a plan returned by load_plan(),
+writing output_file only if it changed. Returns True if output_file was written.
+"""
+def build_output(output_file, kind, keys_file, plan):
+    data = render_output(kind, plan, read_keyrom(keys_file, plan.depth))
+    return write_if_changed(output_file, data)
+
+"""
+Batch sealing.
+
+Provisioning seals many keys against one bitstream. --batch takes either a directory of key
+files (every *.bin in it except earlier *.patched.bin outputs, sorted by name) or a manifest with one "keyfile [output]" pair per
+line, and writes one output per key: a patch file, or a patched bitstream with --bitstream.
+The databases and the patch plan are loaded once for the whole batch, and the per-key apply
+step can be spread over a process pool with --jobs.
+"""
+def batch_jobs(batch, output_dir, suffix):
+    if os.path.isdir(batch):
+        key_files = [os.path.join(batch, name) for name in sorted(os.listdir(batch))
+                     if name.endswith('.bin') and not name.endswith('.patched.bin')]
+        pairs = [(key_file, None) for key_file in key_files]
+    else:
+        pairs = []
+        with open(batch, "r") as f:
+            for line in f:
+                items = line.split()
+                if len(items) == 0 or items[0].startswith('#'):
+                    continue
+                pairs.append((items[0], items[1] if len(items) > 1 else None))
+
+    jobs = []
+    outputs = {}
+    for (key_file, output_file) in pairs:
+        if output_file is None:
+            name = os.path.splitext(os.path.basename(key_file))[0] + suffix
+            if output_dir is None:
+                output_file = os.path.join(os.path.dirname(key_file), name)
+            else:
+                output_file = os.path.join(output_dir, name)
+        if os.path.abspath(output_file) == os.path.abspath(key_file):
+            raise ValueError("{}: batch output would overwrite the key file".format(key_file))
+        path = os.path.abspath(output_file)
+        if path in outputs:
+            raise ValueError("{}: batch output {} is also the output for {}".format(key_file, output_file, outputs[path]))
+        outputs[path] = key_file
+        jobs.append((key_file, output_file))
+    return jobs
+
+_batch_plan = None
+
+def _init_batch_worker(plan):
+    global _batch_plan
+    _batch_plan = plan
+
+# seal one key with the plan installed by _init_batch_worker(); returns the time taken
+def _seal_key(key_file, output_file, patch_format, bitstream_file):
+    start = time.perf_counter()
+    with open(key_file, "rb") as f:
+        keyrom = parse_keyrom(f.read())
+    if len(keyrom) != _batch_plan.depth:
+        raise ValueError("{}: key ROM file size is wrong, expected {} words".format(key_file, _batch_plan.depth))
+    patches = _batch_plan.apply(keyrom)
+    if bitstream_file is not None:
+        patch_bitstream(bitstream_file, output_file, patches)
+    elif patch_format == 'binary':
+        with open(output_file, "wb") as f:
+            write_patches(f, patches, 'binary')
+    else:
+        with open(output_file, "w") as f:
+            write_patches(f, patches)
+    return time.perf_counter() - start
+
+# returns a list of (key file, output file, seconds), in job order
+def seal_batch(plan, jobs, patch_format='text', bitstream_file=None, workers=1):
+    if workers <= 1:
+        _init_batch_worker(plan)
+        times = [_seal_key(key_file, output_file, patch_format, bitstream_file) for (key_file, output_file) in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=(plan,)) as pool:
+            futures = [pool.submit(_seal_key, key_file, output_file, patch_format, bitstream_file) for (key_file, output_file) in jobs]
+            times = [future.result() for future in futures]
+    return [(key_file, output_file, t) for ((key_file, output_file), t) in zip(jobs, times)]
+
+def auto_int(x):
+    return int(x, 0)
+
+def main():
+
+    parser = argparse.ArgumentParser(description="key file to bitstream patcher")
+    parser.add_argument("-k", "--keys", help="key ROM file", default="key.bin", type=str)
+    parser.add_argument("-p", "--part", help="Part frame mapping file", default=DEFAULT_PART, type=str)
+    parser.add_argument("-t", "--tilegrid", help="tilegrid file", default=DEFAULT_TILEGRID, type=str)
+    parser.add_argument("-r", "--romdb", help="ROM LUT mapping database", default=DEFAULT_ROMDB, type=str)
+    parser.add_argument("-s", "--segbits", help="segbits file, or directory of segbits_<tile type>.db files; other CLB tile types are loaded from next to it", default=DEFAULT_SEGBITS, type=str)
+    parser.add_argument("-c", "--code", help="Output is rust code, not patch stream", default=False, action="store_true")
+    parser.add_argument("--rom-width", help="key ROM width in bits", default=ROM_WIDTH, type=int)
+    parser.add_argument("--rom-depth", help="key ROM depth in words", default=ROM_DEPTH, type=int)
+    parser.add_argument("--lut-size", help="addresses per ROM LUT", default=LUT_SIZE, type=int, choices=[LUT_SIZE])
+    parser.add_argument("--cache", help="compiled database cache file", default=DEFAULT_CACHE, type=str)
+    parser.add_argument("--no-cache", help="always parse the source databases and derive the plan, ignoring --cache and --plan", default=False, action="store_true")
+    parser.add_argument("--compile-db", help="compile the database cache and exit", default=False, action="store_true")
+    parser.add_argument("--plan", help="patch plan file, derived from rom.db once and reused for every key", default=DEFAULT_PLAN, type=str)
+    parser.add_argument("-f", "--patch-format", help="format of the patch stream, see patchfile.py", choices=['text', 'binary'], default='text', type=str)
+    parser.add_argument("-b", "--bitstream", help="patch the key directly into this (unencrypted) .bin bitstream", type=str)
+    parser.add_argument("-o", "--output", help="output file for the patch list or rust code, written only if it changed; with --bitstream, the patched bitstream file, defaults to patching in place; with --extract, file to save the extracted key ROM to", type=str)
+    parser.add_argument("-x", "--extract", help="extract the key ROM from this bitstream, and compare it against --keys", type=str)
+    parser.add_argument("--batch", help="seal every key in a directory of .bin files, or listed in a manifest of 'keyfile [output]' lines", type=str)
+    parser.add_argument("--batch-output", help="directory for batch outputs, defaults to next to each key file", type=str)
+    parser.add_argument("-j", "--jobs", help="number of worker processes for --batch, and for deriving the plan", default=1, type=int)
+    args = parser.parse_args()
+
+    if args.compile_db:
+        part = PartDatabase.from_sources(args.tilegrid, args.part, args.segbits)
+        write_cache(args.cache, hash_files(args.tilegrid, args.part), part)
+        return
+
+    #-----------  READ IN DATABASES AND DERIVE THE PATCHING PLAN ------------
+    if args.no_cache:
+        cache_file = None
+        plan_file = None
+    else:
+        cache_file = args.cache
+        plan_file = args.plan
+    geometry = RomGeometry(args.rom_width, args.rom_depth, args.lut_size)
+    try:
+        plan = load_plan(args.romdb, args.tilegrid, args.part, args.segbits, cache_file, plan_file, geometry, args.jobs)
+    except RomDbError as e:
+        for problem in e.problems:
+            print("error: {}: {}".format(args.romdb, problem), file=sys.stderr)
+        return 1
+
+    #-----------  EXTRACT AND VERIFY A KEY ROM ------------
+    if args.extract is not None:
+        extracted = extract_keyrom(args.extract, plan)
+        if args.output is not None:
+            with open(args.output, "wb") as f:
+                f.write(b''.join(word.to_bytes(4, 'big') for word in extracted))
+        with open(args.keys, "rb") as f:
+            keyrom = parse_keyrom(f.read())
+        mismatches = [adr for adr in range(plan.depth) if adr >= len(keyrom) or keyrom[adr] != extracted[adr]]
+        if len(mismatches) != 0:
+            print("key ROM in {} does not match {}: {} of {} words differ, first at address {}".format(
+                args.extract, args.keys, len(mismatches), plan.depth, mismatches[0]))
+            return 1
+        print("key ROM in {} matches {}".format(args.extract, args.keys))
+        return 0
+
+    #-----------  SEAL A BATCH OF KEYS ------------
+    if args.batch is not None:
+        if args.bitstream is not None:
+            suffix = '.patched.bin'
+        elif args.patch_format == 'binary':
+            suffix = '.kpatch'
+        else:
+            suffix = '.patch'
+        try:
+            jobs = batch_jobs(args.batch, args.batch_output, suffix)
+        except ValueError as e:
+            print("error: {}".format(e), file=sys.stderr)
+            return 1
+        if args.batch_output is not None:
+            os.makedirs(args.batch_output, exist_ok=True)
+        start = time.perf_counter()
+        results = seal_batch(plan, jobs, args.patch_format, args.bitstream, args.jobs)
+        elapsed = time.perf_counter() - start
+        for (key_file, output_file, seconds) in results:
+            print("{} -> {}: {:.1f} ms".format(key_file, output_file, seconds * 1000))
+        if elapsed > 0:
+            print("sealed {} keys in {:.3f} s, {:.1f} keys/s".format(len(results), elapsed, len(results) / elapsed))
+        return
+
+    #-----------  WRITE AN OUTPUT FILE, IF IT CHANGED ------------
+    if args.output is not None and args.bitstream is None:
+        if args.code:
+            kind = 'rust'
+        else:
+            kind = args.patch_format
+        build_output(args.output, kind, args.keys, plan)
+        return 0
+
+    #-----------  READ IN KEY DATA ------------
+    keyrom = read_keyrom(args.keys, plan.depth)
+    patches = plan.apply(keyrom)
+
+    #-----------  PATCH THE BITSTREAM DIRECTLY ------------
+    if args.bitstream is not None:
+        patch_bitstream(args.bitstream, args.output, patches)
+        return
+
+    #-----------  OUTPUT THE PATCHING LIST ------------
+    if args.code == False:
+        if args.patch_format == 'binary':
+            write_patches(sys.stdout.buffer, patches, 'binary')
+        else:
+            write_patches(sys.stdout, patches)
+    else:
+        write_rust(sys.stdout, plan, keyrom, patches)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
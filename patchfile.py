@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+"""
+Reader and writer for key ROM patch files, as generated by key2bits.py.
+
+Two formats are supported.
+
+The text format is one line per patched frame: the framestream position, followed by 101
+comma-separated fields, one per frame word, each either 'none' or the replacement value:
+
+  0x0000035e,0x8318913a,0x46f3f970,none,...
+
+The binary format is a header followed by fixed-size records, one per patched word, sorted by
+framestream position and then word offset. All fields are little-endian:
+
+  header   magic 'K2PF', version u32, record count u32
+  record   framestream position u32, word offset u16, value u32
+
+Because the records are sorted, a consumer can apply them while reading the bitstream
+sequentially, holding only the next record in memory.
+"""
+
+import argparse
+import struct
+import sys
+
+MAGIC = b'K2PF'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+RECORD = struct.Struct('<IHI')
+FRAME_WORDS = 101
+READ_RECORDS = 4096 # records read per chunk when streaming
+
+# patches is a list of (framestream position, [(word offset, value), ...]), sorted
+def write_binary(f, patches):
+    count = sum(len(words) for (frame, words) in patches)
+    f.write(HEADER.pack(MAGIC, VERSION, count))
+    last = None
+    out = bytearray()
+    for (frame, words) in patches:
+        for (word, value) in words:
+            if last is not None and (frame, word) <= last:
+                raise ValueError("patch records must be sorted and unique")
+            last = (frame, word)
+            out += RECORD.pack(frame, word, value)
+    f.write(out)
+
+# yields (framestream position, word offset, value) records in order, reading in chunks
+def iter_binary(f):
+    (magic, version, count) = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("not a binary patch file")
+    if version != VERSION:
+        raise ValueError("unsupported patch file version {}".format(version))
+    while count > 0:
+        chunk = min(count, READ_RECORDS)
+        data = f.read(chunk * RECORD.size)
+        if len(data) != chunk * RECORD.size:
+            raise ValueError("patch file is truncated")
+        yield from RECORD.iter_unpack(data)
+        count -= chunk
+
+def write_text(f, patches):
+    for (frame, words) in patches:
+        values = dict(words)
+        fields = ["0x{:08x}".format(frame)]
+        for word in range(FRAME_WORDS):
+            if word not in values:
+                fields.append('none')
+            else:
+                fields.append('0x{:08x}'.format(values[word]))
+        f.write(','.join(fields) + '\n')
+
+# yields (framestream position, word offset, value) records in order
+def iter_text(f):
+    for line in f:
+        fields = line.strip().split(',')
+        if len(fields) < 2:
+            continue
+        frame = int(fields[0], 16)
+        for (word, value) in enumerate(fields[1:]):
+            if value != 'none':
+                yield (frame, word, int(value, 16))
+
+# group a record stream back into (framestream position, [(word offset, value), ...])
+def group_records(records):
+    patches = []
+    for (frame, word, value) in records:
+        if len(patches) == 0 or patches[-1][0] != frame:
+            patches.append((frame, []))
+        patches[-1][1].append((word, value))
+    return patches
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert key ROM patch files between binary and text")
+    parser.add_argument("input", help="binary patch file", type=str)
+    parser.add_argument("-o", "--output", help="text output file, defaults to stdout", type=str)
+    args = parser.parse_args()
+
+    with open(args.input, "rb") as f:
+        patches = group_records(iter_binary(f))
+    if args.output is None:
+        write_text(sys.stdout, patches)
+    else:
+        with open(args.output, "w") as f:
+            write_text(f, patches)
+
+if __name__ == "__main__":
+    main()
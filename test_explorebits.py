@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+
+"""
+Check that explorebits.py reads KEYROM cell INITs out of generated Verilog. The sample is
+Instance output as written by Migen 0.9.2, which prints integer parameters in decimal.
+"""
+
+import explorebits
+
+MIGEN_SAMPLE = """
+LUT6 #(
+	.INIT(63'd6610613814169821635)
+) KEYROM0A (
+	.I0(keyrom_adr[0]),
+	.I1(keyrom_adr[1]),
+	.I2(keyrom_adr[2]),
+	.I3(keyrom_adr[3]),
+	.I4(keyrom_adr[4]),
+	.I5(keyrom_adr[5]),
+	.O(keyrom_bit0a)
+);
+
+LUT6 #(
+	.INIT(64'd12016542055746873027)
+) KEYROM31D (
+	.I0(keyrom_adr[0]),
+	.O(keyrom_bit31d)
+);
+"""
+
+def test_migen_decimal():
+    assert explorebits.cell_inits_from_verilog(MIGEN_SAMPLE) == {
+        'KEYROM0A': 6610613814169821635,
+        'KEYROM31D': 12016542055746873027,
+    }
+
+def test_hex_and_binary():
+    verilog = ("LUT6 #(.INIT(64'h5BBD_9E3D_4CE1_E1C3)) KEYROM3B (.O(o));\n"
+               "LUT6 #(.INIT(4'b1010)) KEYROM4C (.O(o));\n"
+               "LUT6 #(.INIT(64'hA6C355555555A6C3)) OTHER (.O(o));\n")
+    assert explorebits.cell_inits_from_verilog(verilog) == {
+        'KEYROM3B': 0x5BBD9E3D4CE1E1C3,
+        'KEYROM4C': 0b1010,
+    }
+
+if __name__ == "__main__":
+    test_migen_decimal()
+    test_hex_and_binary()
+    print("ok")
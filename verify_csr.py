@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+
+"""
+Check the signature on a SoC image built by append_csr.py (e.g. build/gateware/soc_csr.bin).
+
+The public key is read from an X.509 certificate or a public key PEM file, and defaults to
+the developer key certificate. Images signed with either signer version are accepted; see
+append_csr.py for the difference between them.
+"""
+
+import argparse
+import sys
+
+from Crypto.PublicKey import ECC
+
+import append_csr
+
+DEVCERT_PATH = './devkey/dev-x509.crt'
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify the signature on a SoC image")
+    parser.add_argument("image", help="signed image, as written by append_csr.py", type=str)
+    parser.add_argument("--key", help="X.509 certificate or public key PEM to check against", default=DEVCERT_PATH, type=str)
+    args = parser.parse_args()
+
+    with open(args.key) as f:
+        key = ECC.import_key(f.read())
+    if key.curve != 'Ed25519':
+        print("{} is not an Ed25519 key".format(args.key))
+        return 1
+    public_key = key.public_key().export_key(format='raw')
+
+    with open(args.image, "rb") as f:
+        try:
+            version = append_csr.verify_image(f, public_key)
+        except ValueError as e:
+            print("{}: {}".format(args.image, e))
+            return 1
+    print("{}: signature OK (signer version {})".format(args.image, version))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+"""
+Minimal parser for 7-series configuration bitstreams, as described in UG470.
+
+A bitstream is some preamble junk, the sync word 0xAA995566, and then a sequence of packets:
+
+  type 1: [31:29] = 001, [28:27] opcode, [26:13] register address, [10:0] word count
+  type 2: [31:29] = 010, [28:27] opcode, [26:0] word count; writes to the register of the
+          preceding type 1 packet, and is used for the bulk frame data written to FDRI
+
+The configuration frames are the payload of the (single) FDRI write. Frames are 101 words,
+and are implicitly addressed: frame N of the "framestream" starts at word N * 101 of the
+FDRI payload. All words are big-endian.
+
+BitstreamLayout is the shared parser for tools that work on bitstream files (key2bits.py,
+explorebits.py, append_csr.py): it finds the sync word with a single bytes.find() and
+walks the packet headers, so callers get the packet list and the frame data offsets
+without scanning the data themselves. Run as a script, it prints the packet list.
+
+The device keeps a running CRC-32C over every word written to a register, together with the
+register address. The CRC is reset by the RCRC command and after each write to the CRC
+register, which checks the running value against the written one. The CRC is linear, so
+when frame words are patched, every following CRC check can be fixed up by XORing in the
+CRC of the difference stream, without recomputing the CRC over the whole bitstream.
+"""
+
+import argparse
+import struct
+import sys
+from collections import namedtuple
+
+SYNC_WORD = 0xAA995566
+FRAME_WORDS = 101
+
+# configuration registers
+REG_CRC = 0x00
+REG_FAR = 0x01
+REG_FDRI = 0x02
+REG_CMD = 0x04
+REG_CBC = 0x0B
+REG_DWC = 0x16
+
+# CMD register codes
+CMD_RCRC = 0x07
+CMD_DESYNC = 0x0D
+
+OPCODE_NOOP = 0
+OPCODE_READ = 1
+OPCODE_WRITE = 2
+
+CRC32C_POLY = 0x82F63B78
+
+REGISTER_NAMES = {
+    REG_CRC: 'CRC', REG_FAR: 'FAR', REG_FDRI: 'FDRI', 0x03: 'FDRO', REG_CMD: 'CMD', 0x05: 'CTL0',
+    0x06: 'MASK', 0x07: 'STAT', 0x08: 'LOUT', 0x09: 'COR0', 0x0A: 'MFWR', REG_CBC: 'CBC',
+    0x0C: 'IDCODE', 0x0D: 'AXSS', 0x0E: 'COR1', 0x10: 'WBSTAR', 0x11: 'TIMER', 0x16: 'BOOTSTS',
+    0x18: 'CTL1', 0x1F: 'BSPI',
+}
+OPCODE_NAMES = {OPCODE_NOOP: 'NOP', OPCODE_READ: 'READ', OPCODE_WRITE: 'WRITE', 3: 'RESERVED'}
+
+"""
+A parsed packet. offset is the byte offset of the header, data_offset the byte offset of
+the first payload word, and stream_index the index of the first payload word in the stream
+of register writes that feeds the CRC.
+"""
+Packet = namedtuple('Packet', ['offset', 'header_type', 'opcode', 'register', 'word_count', 'data_offset', 'stream_index'])
+
+def find_sync(data, start=0):
+    return data.find(SYNC_WORD.to_bytes(4, 'big'), start)
+
+def parse_packets(data, sync_offset):
+    packets = []
+    position = sync_offset + 4
+    register = None
+    stream_index = 0
+    while position + 4 <= len(data):
+        (header,) = struct.unpack_from('>I', data, position)
+        header_type = header >> 29
+        opcode = (header >> 27) & 3
+        if header_type == 1:
+            register = (header >> 13) & 0x3FFF
+            word_count = header & 0x7FF
+        elif header_type == 2:
+            word_count = header & 0x7FFFFFF
+        else:
+            break # not a packet, we've run off the end of the configuration data
+        packet = Packet(position, header_type, opcode, register, word_count, position + 4, stream_index)
+        packets.append(packet)
+        if opcode == OPCODE_WRITE:
+            stream_index += word_count
+        position += 4 + word_count * 4
+        if packet.opcode == OPCODE_WRITE and register == REG_CMD and word_count == 1:
+            if command(data, packet) == CMD_DESYNC:
+                break
+    return packets
+
+def command(data, packet):
+    return struct.unpack_from('>I', data, packet.data_offset)[0]
+
+class BitstreamLayout:
+    def __init__(self, data):
+        self.sync_offset = find_sync(data)
+        if self.sync_offset < 0:
+            raise ValueError("no sync word found, is this a bitstream?")
+        self.packets = parse_packets(data, self.sync_offset)
+
+        writes = [p for p in self.packets if p.opcode == OPCODE_WRITE]
+        self.encrypted = any(p.register in (REG_CBC, REG_DWC) for p in writes)
+        fdri = [p for p in writes if p.register == REG_FDRI and p.word_count != 0]
+        self.fdri = fdri[0] if len(fdri) == 1 else None
+
+    # the frame data, as (byte offset, word count)
+    def frame_data(self):
+        if self.fdri is None:
+            raise ValueError("bitstream does not have exactly one FDRI write, can't locate frame data")
+        return (self.fdri.data_offset, self.fdri.word_count)
+
+    # byte offset of a word within the frame data
+    def frame_word_offset(self, frame, word):
+        (offset, count) = self.frame_data()
+        index = frame * FRAME_WORDS + word
+        if word >= FRAME_WORDS or index >= count:
+            raise ValueError("frame {} word {} is outside of the frame data".format(frame, word))
+        return offset + index * 4
+
+"""
+Read frame words out of the frame data. locations is a list of (framestream position,
+[word offset, ...]); the values are returned as a flat list in the same order. When the
+locations are sorted, this is a single forward pass over the bitstream.
+"""
+def read_frames(data, layout, locations):
+    values = []
+    for (frame, words) in locations:
+        for word in words:
+            values.append(struct.unpack_from('>I', data, layout.frame_word_offset(frame, word))[0])
+    return values
+
+"""
+CRC-32C as computed by the configuration logic: the 32-bit data word and then the 5-bit
+register address are shifted in LSB first.
+"""
+def icap_crc(register, word, crc):
+    value = (register << 32) | word
+    for i in range(37):
+        if (value ^ crc) & 1:
+            crc = (crc >> 1) ^ CRC32C_POLY
+        else:
+            crc >>= 1
+        value >>= 1
+    return crc
+
+def _gf2_apply(matrix, vector):
+    result = 0
+    bit = 0
+    while vector != 0:
+        if vector & 1:
+            result ^= matrix[bit]
+        vector >>= 1
+        bit += 1
+    return result
+
+# zero-word CRC advance, as GF(2) matrices stored as 32 column vectors, for 2^0 .. 2^31 steps
+_CRC_ADVANCE = [[icap_crc(0, 0, 1 << bit) for bit in range(32)]]
+while len(_CRC_ADVANCE) < 32:
+    _CRC_ADVANCE.append([_gf2_apply(_CRC_ADVANCE[-1], column) for column in _CRC_ADVANCE[-1]])
+
+# advance a CRC state over `words` register writes of zero data to register zero
+def crc_advance(crc, words):
+    power = 0
+    while words != 0 and crc != 0:
+        if words & 1:
+            crc = _gf2_apply(_CRC_ADVANCE[power], crc)
+        words >>= 1
+        power += 1
+    return crc
+
+"""
+Patch frame words in place in a writable buffer (e.g. an mmap of the bitstream), and fix up
+the CRC checks that follow. patches is a list of (framestream position, [(word offset, value)]).
+"""
+def patch_frames(data, layout, patches):
+    if layout.encrypted:
+        raise ValueError("bitstream is encrypted, frame data can't be patched directly")
+
+    # locate every word before touching the bitstream, so a bad patch leaves it intact
+    targets = [(layout.frame_word_offset(frame, word), value) for (frame, words) in patches for (word, value) in words]
+
+    # collect the CRC difference stream: (stream index, xor of old and new word)
+    deltas = []
+    for (offset, value) in targets:
+        (old,) = struct.unpack_from('>I', data, offset)
+        struct.pack_into('>I', data, offset, value)
+        if old != value:
+            deltas.append((layout.fdri.stream_index + (offset - layout.fdri.data_offset) // 4, old ^ value))
+    deltas.sort()
+
+    crc = 0        # CRC of the difference stream
+    at = 0         # stream index that crc has been advanced to
+    next_delta = 0
+    for packet in layout.packets:
+        if packet.opcode != OPCODE_WRITE or packet.word_count == 0:
+            continue
+        # fold in the differences that land in this packet
+        while next_delta < len(deltas) and deltas[next_delta][0] < packet.stream_index + packet.word_count:
+            (index, delta) = deltas[next_delta]
+            crc = icap_crc(0, delta, crc_advance(crc, index - at))
+            at = index + 1
+            next_delta += 1
+        if packet.register == REG_CRC:
+            crc = crc_advance(crc, packet.stream_index - at)
+            if crc != 0:
+                (expected,) = struct.unpack_from('>I', data, packet.data_offset)
+                struct.pack_into('>I', data, packet.data_offset, expected ^ crc)
+            crc = 0
+            at = packet.stream_index + packet.word_count
+        elif packet.register == REG_CMD and packet.word_count == 1 and command(data, packet) == CMD_RCRC:
+            crc = 0
+            at = packet.stream_index + packet.word_count
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the configuration packets of a 7-series bitstream")
+    parser.add_argument("bitstream", help="bitstream file (.bin or .bit)", type=str)
+    args = parser.parse_args()
+
+    with open(args.bitstream, "rb") as f:
+        data = f.read()
+    layout = BitstreamLayout(data)
+    print("sync word at 0x{:x}".format(layout.sync_offset))
+    for packet in layout.packets:
+        register = REGISTER_NAMES.get(packet.register, "0x{:02x}".format(packet.register))
+        if packet.opcode == OPCODE_NOOP:
+            register = ''
+        line = "0x{:08x} type {} {:5} {:7} {} words".format(packet.offset, packet.header_type, OPCODE_NAMES[packet.opcode],
+                                                            register, packet.word_count)
+        if packet.opcode == OPCODE_WRITE and packet.word_count == 1:
+            line += ": 0x{:08x}".format(command(data, packet))
+        print(line)
+    if layout.encrypted:
+        print("encrypted")
+    elif layout.fdri is not None:
+        (offset, count) = layout.frame_data()
+        print("frame data at 0x{:x}, {} frames".format(offset, count // FRAME_WORDS))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())